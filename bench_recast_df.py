@@ -0,0 +1,63 @@
+"""A benchmark for elsapy.utils.recast_df: compares it with the original
+    row-by-row (.apply) implementation on synthetic search result frames.
+    Usage: python bench_recast_df.py [number of rows ...]"""
+
+import random, sys, time
+import pandas as pd
+from elsapy.utils import recast_df
+
+
+def recast_df_apply(df):
+    """The original, row-by-row implementation of recast_df, for reference"""
+    if 'link' in df.columns:
+        if '@rel' in df.link[0][0].keys():
+            link_type_key ='@rel'
+        else:
+            link_type_key = '@ref'
+        df['link'] = df.link.apply(
+            lambda x: dict([(e[link_type_key], e['@href']) for e in x]))
+    for int_field in ['document-count', 'citedby-count']:
+        if int_field in df.columns:
+            df[int_field] = df[int_field].apply(int)
+    for date_field in ['prism:coverDate']:
+        if date_field in df.columns:
+            df[date_field] = df[date_field].apply(pd.Timestamp)
+    return df
+
+
+def synthetic_results(num_rows):
+    """Returns a list of num_rows search results, shaped like Scopus ones"""
+    random.seed(num_rows)
+    return [{
+        'eid': '2-s2.0-%d' % (85000000000 + i),
+        'dc:title': 'Title %d' % i,
+        'citedby-count': str(random.randint(0, 5000)),
+        'prism:coverDate': '%d-%02d-%02d' % (random.randint(1970, 2024),
+                                             random.randint(1, 12),
+                                             random.randint(1, 28)),
+        'link': [
+            {'@ref': 'self', '@href': 'https://api.elsevier.com/content/abstract/scopus_id/%d' % i},
+            {'@ref': 'author-affiliation', '@href': 'https://api.elsevier.com/content/abstract/scopus_id/%d?field=author,affiliation' % i},
+            {'@ref': 'scopus', '@href': 'https://www.scopus.com/inward/record.uri?partnerID=HzOxMe3b&scp=%d' % i},
+            {'@ref': 'scopus-citedby', '@href': 'https://www.scopus.com/inward/citedby.uri?partnerID=HzOxMe3b&scp=%d' % i},
+            ],
+        } for i in range(num_rows)]
+
+
+def time_recast(recast, results):
+    """Returns the number of seconds recast takes on a frame of results"""
+    df = pd.DataFrame(results)
+    start = time.perf_counter()
+    recast(df)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    print('%10s %12s %12s %8s' % ('rows', 'apply (s)', 'recast_df (s)', 'speedup'))
+    for num_rows in sizes:
+        results = synthetic_results(num_rows)
+        t_apply = time_recast(recast_df_apply, results)
+        t_recast = time_recast(recast_df, results)
+        print('%10d %12.3f %12.3f %7.1fx' % (num_rows, t_apply, t_recast,
+                                            t_apply / t_recast))
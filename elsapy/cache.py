@@ -0,0 +1,167 @@
+"""The response cache module of elsapy. Used by elsclient.
+    Additional resources:
+    * https://github.com/ElsevierDev/elsapy
+    * https://dev.elsevier.com
+    * https://api.elsevier.com"""
+
+import hashlib, json, os, threading, time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from . import log_util
+from .ratelimit import endpoint_family
+try:
+    import pathlib
+except ImportError:
+    import pathlib2 as pathlib
+
+logger = log_util.get_logger(__name__)
+
+
+class ResponseCache:
+    """An on-disk cache of API responses, keyed by normalized request URL
+        (so that e.g. the order of query parameters or of the fields in
+        the field= parameter does not matter). Responses expire after a
+        time-to-live per endpoint family; once the cache grows beyond
+        max_size bytes, the least recently used responses are evicted."""
+
+    # class variables
+    default_ttls = {                            ## Time-to-live in seconds
+        'search'        : 24 * 3600,
+        'abstract'      : 7 * 24 * 3600,
+        'author'        : 7 * 24 * 3600,
+        'affiliation'   : 7 * 24 * 3600,
+        'article'       : 30 * 24 * 3600,
+        'default'       : 24 * 3600,
+    }
+
+    def __init__(self, path, ttls = None, max_size = 1024 ** 3):
+        """Initializes a cache in the given directory. Ttls, if given, is a
+            dict of time-to-live in seconds per endpoint family that
+            overrides default_ttls; a time-to-live of 0 disables caching for
+            that family. Responses already in the directory are reused."""
+        self._path = pathlib.Path(path)
+        self._path.mkdir(parents = True, exist_ok = True)
+        self._ttls = dict(self.default_ttls)
+        if ttls:
+            self._ttls.update(ttls)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        ## Sizes of the cached responses, least recently used first
+        self._index = OrderedDict()
+        self._size = 0
+        files = sorted(self._path.glob('*/*.json'), key = lambda f: f.stat().st_mtime)
+        for f in files:
+            self._index[f.stem] = f.stat().st_size
+            self._size += self._index[f.stem]
+
+    # properties
+    @property
+    def path(self):
+        """Gets the directory the cache is stored in"""
+        return self._path
+
+    @property
+    def stats(self):
+        """Gets the cache's hit and miss counts, number of entries and size
+            in bytes"""
+        with self._lock:
+            return {
+                'hits'      : self._hits,
+                'misses'    : self._misses,
+                'entries'   : len(self._index),
+                'size'      : self._size,
+                }
+
+    @staticmethod
+    def normalize(url):
+        """Returns the normalized form of a URL that is used as cache key."""
+        parts = urlsplit(url)
+        params = []
+        for name, value in parse_qsl(parts.query, keep_blank_values = True):
+            if name == 'field':
+                value = ','.join(sorted(value.split(',')))
+            params.append((name, value))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                           parts.path, urlencode(sorted(params)), ''))
+
+    def _key(self, url):
+        """Returns the cache key for a URL."""
+        return hashlib.sha1(self.normalize(url).encode('utf-8')).hexdigest()
+
+    def _file(self, key):
+        """Returns the path of the file a response is cached in."""
+        return self._path / key[:2] / (key + '.json')
+
+    def _remove(self, key):
+        """Removes a response from the cache; needs self._lock."""
+        self._size -= self._index.pop(key, 0)
+        try:
+            self._file(key).unlink()
+        except OSError:
+            pass
+
+    def get(self, url):
+        """Returns the cached response for a URL, or None if the URL has not
+            been cached or its response has expired."""
+        key = self._key(url)
+        with self._lock:
+            if key not in self._index:
+                self._misses += 1
+                return None
+        ## Read outside the lock, so that hits can be served concurrently;
+        ##  files are replaced atomically, but may be evicted meanwhile.
+        try:
+            with self._file(key).open() as f:
+                entry = json.load(f)
+        except OSError:
+            with self._lock:
+                self._misses += 1
+            return None
+        except ValueError:
+            with self._lock:
+                self._remove(key)
+                self._misses += 1
+            return None
+        if time.time() - entry['fetched'] > self._ttls.get(
+                endpoint_family(url), self._ttls['default']):
+            with self._lock:
+                self._remove(key)
+                self._misses += 1
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            self._hits += 1
+        try:
+            os.utime(str(self._file(key)))
+        except OSError:
+            pass
+        logger.info('Cache hit for ' + url)
+        return entry['data']
+
+    def put(self, url, data):
+        """Caches the response for a URL, evicting the least recently used
+            responses if the cache grows beyond its max. size."""
+        if self._ttls.get(endpoint_family(url), self._ttls['default']) <= 0:
+            return
+        key = self._key(url)
+        cache_file = self._file(key)
+        cache_file.parent.mkdir(exist_ok = True)
+        tmp_file = cache_file.with_suffix('.tmp%d' % threading.get_ident())
+        with tmp_file.open(mode = 'w') as f:
+            json.dump({'url': url, 'fetched': time.time(), 'data': data}, f)
+        size = tmp_file.stat().st_size
+        with self._lock:
+            os.replace(str(tmp_file), str(cache_file))
+            self._size += size - self._index.pop(key, 0)
+            self._index[key] = size
+            while self._size > self.max_size and len(self._index) > 1:
+                self._remove(next(iter(self._index)))
+
+    def clear(self):
+        """Removes all responses from the cache."""
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
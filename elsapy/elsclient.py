@@ -5,8 +5,14 @@
     * https://api.elsevier.com"""
 
 
-import requests, json, time
+import requests, json, os, time, asyncio, functools, threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from . import log_util
+from .ratelimit import RateLimiter
+from .retry import RetryPolicy
+from .cache import ResponseCache
+from .store import JsonFileStore, MemoryStore
 from .__init__ import version
 try:
     import pathlib
@@ -21,15 +27,29 @@ class ElsClient:
     # class variables
     __url_base = "https://api.elsevier.com/"    ## Base URL for later use
     __user_agent = "elsapy-v%s" % version       ## Helps track library use
-    __min_req_interval = 1                      ## Min. request interval in sec
-    __ts_last_req = time.time()                 ## Tracker for throttling
+    __max_page_sizes = {                        ## Max. results per page, by
+        ('scopus', 'STANDARD')          : 200,  ##  search index and view
+        ('scopus', 'COMPLETE')          : 25,
+        ('sciencedirect', 'STANDARD')   : 100,
+        ('sciencedirect', 'COMPLETE')   : 25,
+        ('author', 'STANDARD')          : 200,
+        ('author', 'COMPLETE')          : 25,
+        ('affiliation', 'STANDARD')     : 200,
+        }
+    __default_page_size = 25                    ## For unknown index/view pairs
+    cache_policies = ('network-only', 'local-first', 'local-only')
  
     # constructors
-    def __init__(self, api_key, inst_token = None, num_res = 25, local_dir = None):
-        # TODO: make num_res configurable for searches and documents/authors view
-        #   - see https://github.com/ElsevierDev/elsapy/issues/32
+    def __init__(self, api_key, inst_token = None, num_res = None, local_dir = None,
+                 pool_connections = 10, pool_maxsize = 10, pool_block = False,
+                 keep_alive = True, rate_limiter = None, retry_policy = None,
+                 cache = None, conditional_requests = False, max_age = None,
+                 store = None, cache_policy = 'network-only', memory_store = True):
         """Initializes a client with a given API Key and, optionally, institutional
-            token, number of results per request, and local data path."""
+            token, number of results per request and local data path. The
+            pool_* arguments size its connection pool; cache = True and
+            memory_store = True set up a default ResponseCache and MemoryStore.
+            See the properties for the other options."""
         self.api_key = api_key
         self.inst_token = inst_token
         self.num_res = num_res
@@ -39,6 +59,40 @@ class ElsClient:
             self.local_dir = pathlib.Path(local_dir)
         if not self.local_dir.exists():
             self.local_dir.mkdir()
+        self.keep_alive = keep_alive
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.conditional_requests = conditional_requests
+        self.max_age = max_age
+        self.store = store
+        self.cache_policy = cache_policy
+        if memory_store is True:
+            self.memory_store = MemoryStore()
+        else:
+            self.memory_store = memory_store
+        if cache is True:
+            self.cache = ResponseCache(self.local_dir / 'cache')
+        else:
+            self.cache = cache
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections = pool_connections,
+            pool_maxsize = pool_maxsize,
+            pool_block = pool_block
+            )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the client's connection pool. The client can still be used
+            afterwards, but will have to open new connections."""
+        self._session.close()
 
     # properties
     @property
@@ -61,12 +115,16 @@ class ElsClient:
 
     @property
     def num_res(self):
-        """Gets the max. number of results to be used by the client instance"""
+        """Gets the max. number of results per request to be used by the client
+            instance; None means the max. the API allows"""
         return self._num_res
     
     @num_res.setter
     def num_res(self, numRes):
-        """Sets the max. number of results to be used by the client instance"""
+        """Sets the max. number of results per request to be used by the client
+            instance; None means the max. the API allows"""
+        if numRes is not None and (not isinstance(numRes, int) or numRes < 1):
+            raise ValueError('Number of results must be a positive integer or None')
         self._num_res = numRes
 
     @property
@@ -84,21 +142,154 @@ class ElsClient:
         """Sets the local path to write data to."""
         self._local_dir = pathlib.Path(path_str)
 
+    @property
+    def keep_alive(self):
+        """Gets whether connections are kept open between requests"""
+        return self._keep_alive
+
+    @keep_alive.setter
+    def keep_alive(self, keep_alive):
+        """Sets whether connections are kept open between requests"""
+        self._keep_alive = keep_alive
+
+    @property
+    def rate_limiter(self):
+        """Gets the rate limiter that throttles the client's requests. Unless
+            one was set explicitly, this is the limiter shared by all clients
+            in the process that use the same API key."""
+        if self._rate_limiter:
+            return self._rate_limiter
+        else:
+            return RateLimiter.for_key(self.api_key)
+
+    @rate_limiter.setter
+    def rate_limiter(self, rate_limiter):
+        """Sets the rate limiter that throttles the client's requests; None
+            reverts to the limiter shared for the client's API key."""
+        self._rate_limiter = rate_limiter
+
+    @property
+    def retry_policy(self):
+        """Gets the policy for retrying failed requests"""
+        return self._retry_policy
+
+    @retry_policy.setter
+    def retry_policy(self, retry_policy):
+        """Sets the policy for retrying failed requests"""
+        self._retry_policy = retry_policy
+
+    @property
+    def cache(self):
+        """Gets the cache responses are served from; None if responses
+            are not cached"""
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache):
+        """Sets the cache responses are served from; None to disable
+            caching"""
+        self._cache = cache
+
+    @property
+    def conditional_requests(self):
+        """Gets whether entity reads use conditional requests to avoid
+            downloading unchanged entities again"""
+        return self._conditional_requests
+
+    @conditional_requests.setter
+    def conditional_requests(self, conditional_requests):
+        """Sets whether entity reads use conditional requests to avoid
+            downloading unchanged entities again"""
+        self._conditional_requests = conditional_requests
+
+    @property
+    def max_age(self):
+        """Gets the age in seconds up to which a local copy of an entity
+            is used instead of downloading it again, with the 'local-first'
+            cache policy or if it has no validators"""
+        return self._max_age
+
+    @max_age.setter
+    def max_age(self, max_age):
+        """Sets the age in seconds up to which a local copy of an entity
+            is used instead of downloading it again, with the 'local-first'
+            cache policy or if it has no validators"""
+        self._max_age = max_age
+
+    @property
+    def store(self):
+        """Gets the store entities are written to. Unless one was set
+            explicitly, this is a JsonFileStore in the local data path."""
+        if self._store is not None:
+            return self._store
+        else:
+            return JsonFileStore(self.local_dir)
+
+    @store.setter
+    def store(self, store):
+        """Sets the store entities are written to; None reverts to a
+            JsonFileStore in the local data path."""
+        self._store = store
+
+    @property
+    def cache_policy(self):
+        """Gets where entities are read from by default: 'network-only',
+            'local-first' or 'local-only'"""
+        return self._cache_policy
+
+    @cache_policy.setter
+    def cache_policy(self, cache_policy):
+        """Sets where entities are read from by default: 'network-only',
+            'local-first' or 'local-only'"""
+        if cache_policy not in self.cache_policies:
+            raise ValueError('Cache policy must be one of ' + ', '.join(self.cache_policies))
+        self._cache_policy = cache_policy
+
+    @property
+    def memory_store(self):
+        """Gets the in-process store entities read with a local cache
+            policy are kept in; None if they are not kept in memory"""
+        return self._memory_store
+
+    @memory_store.setter
+    def memory_store(self, memory_store):
+        """Sets the in-process store entities read with a local cache
+            policy are kept in; None to not keep them in memory"""
+        self._memory_store = memory_store
+
+    @property
+    def quota(self):
+        """Gets the remaining (weekly) quota per endpoint family, as last
+            reported by the API."""
+        return self.rate_limiter.quota
+
     # access functions
     def getBaseURL(self):
         """Returns the ELSAPI base URL currently configured for the client"""
         return self.__url_base
 
+    def page_size(self, index, view = None, count = None):
+        """Returns the number of results to request per page from a search
+            index with the given view: count if given, else the client's
+            num_res, else the max. the API allows for that index and view;
+            in any case no more than that max."""
+        max_size = self.__max_page_sizes.get(
+            (index, (view or 'STANDARD').upper()), self.__default_page_size)
+        size = count or self.num_res or max_size
+        if size > max_size:
+            logger.info('Page size ' + str(size) + ' capped at ' + str(max_size)
+                        + ' for ' + index + ' index')
+        return min(size, max_size)
+
     # request/response execution functions
-    def exec_request(self, URL):
-        """Sends the actual request; returns response."""
-
-        ## Throttle request, if need be
-        interval = time.time() - self.__ts_last_req
-        if (interval < self.__min_req_interval):
-            time.sleep( self.__min_req_interval - interval )
-        
-        ## Construct and execute request
+    def _send(self, URL, extra_headers = None, stream = False):
+        """Sends a GET request with the client's headers, plus any extra
+            headers given, throttling and retrying it as need be. Returns the
+            response if it has status 200 or 304; else, raises HTTPError.
+            With stream = True, the body of a successful response is not
+            read yet."""
+
+        ## Construct request
         headers = {
             "X-ELS-APIKey"  : self.api_key,
             "User-Agent"    : self.__user_agent,
@@ -106,16 +297,181 @@ class ElsClient:
             }
         if self.inst_token:
             headers["X-ELS-Insttoken"] = self.inst_token
-        logger.info('Sending GET request to ' + URL)
-        r = requests.get(
-            URL,
-            headers = headers
-            )
-        self.__ts_last_req = time.time()
-        self._status_code=r.status_code
-        if r.status_code == 200:
-            self._status_msg='data retrieved'
-            return json.loads(r.text)
-        else:
-            self._status_msg="HTTP " + str(r.status_code) + " Error from " + URL + " and using headers " + str(headers) + ": " + r.text
-            raise requests.HTTPError("HTTP " + str(r.status_code) + " Error from " + URL + "\nand using headers " + str(headers) + ":\n" + r.text)
+        if not self.keep_alive:
+            headers["Connection"] = 'close'
+        if extra_headers:
+            headers.update(extra_headers)
+
+        attempt = 0
+        while True:
+            ## Throttle request, if need be
+            self.rate_limiter.acquire(URL)
+
+            ## Execute request
+            logger.info('Sending GET request to ' + URL)
+            try:
+                r = self._session.get(
+                    URL,
+                    headers = headers,
+                    stream = stream
+                    )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                wait = self.retry_policy.retry(attempt)
+                if wait is None:
+                    raise
+                logger.warning('Retrying in %.1f s after error: %s' % (wait, e))
+                time.sleep(wait)
+                attempt += 1
+                continue
+            self.rate_limiter.update(URL, r.headers)
+            self._status_code=r.status_code
+            if r.status_code == 200:
+                self._status_msg='data retrieved'
+                return r
+            elif r.status_code == 304:
+                self._status_msg='not modified'
+                return r
+            wait = self.retry_policy.retry(attempt, r)
+            if wait is None:
+                self._status_msg="HTTP " + str(r.status_code) + " Error from " + URL + " and using headers " + str(headers) + ": " + r.text
+                raise requests.HTTPError("HTTP " + str(r.status_code) + " Error from " + URL + "\nand using headers " + str(headers) + ":\n" + r.text)
+            logger.warning('Retrying in %.1f s after HTTP %d from %s' % (wait, r.status_code, URL))
+            ## Release the connection of a streamed response before retrying
+            r.close()
+            time.sleep(wait)
+            attempt += 1
+
+    def exec_request(self, URL):
+        """Sends the actual request; returns response. Retries the request
+            if it fails with an error the client's retry policy deems
+            transient. If the client has a cache, the response is served
+            from it if possible."""
+
+        ## Serve from cache, if possible
+        if self.cache:
+            data = self.cache.get(URL)
+            if data is not None:
+                self._status_code = 200
+                self._status_msg = 'data retrieved from cache'
+                return data
+
+        data = json.loads(self._send(URL).text)
+        if self.cache:
+            self.cache.put(URL, data)
+        return data
+
+    def exec_conditional_request(self, URL, validators = None):
+        """Sends a request that only returns data if it has changed since it
+            was fetched with the given validators (a dict with the 'etag'
+            and/or 'last_modified' of an earlier response). Returns the
+            response (None if not modified) and the validators for it, which
+            also hold the time it was 'fetched'."""
+        headers = {}
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        r = self._send(URL, headers)
+        new_validators = {
+            'etag'          : r.headers.get('ETag'),
+            'last_modified' : r.headers.get('Last-Modified'),
+            'fetched'       : time.time(),
+            }
+        if r.status_code == 304:
+            logger.info('Not modified: ' + URL)
+            for key in ('etag', 'last_modified'):
+                if not new_validators[key] and validators:
+                    new_validators[key] = validators.get(key)
+            return None, new_validators
+        data = json.loads(r.text)
+        if self.cache:
+            self.cache.put(URL, data)
+        return data, new_validators
+
+
+    def exec_download(self, URL, path, accept = 'application/json',
+                      chunk_size = 1024 * 1024):
+        """Downloads the response for a URL in the given format (Accept type,
+            e.g. 'text/xml' or 'application/pdf') straight to a file, in
+            chunks of chunk_size bytes, so that it is never held in memory
+            as a whole. The file is written under a temporary name that is
+            only renamed to path once complete. Responses are not cached.
+            Returns the path."""
+        path = pathlib.Path(path)
+        tmp_path = path.with_name('.tmp-' + path.name)
+        r = self._send(URL, {"Accept": accept}, stream = True)
+        try:
+            with tmp_path.open(mode = 'wb') as tmp_file:
+                for chunk in r.iter_content(chunk_size = chunk_size):
+                    tmp_file.write(chunk)
+            os.replace(str(tmp_path), str(path))
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        finally:
+            r.close()
+        logger.info('Downloaded ' + URL + ' to ' + str(path))
+        return path
+
+
+class AsyncElsClient(ElsClient):
+    """An ElsClient for use with asyncio. Requests are sent exactly as by
+        ElsClient, on a pool of max_concurrency worker threads, and share
+        the rate limiter of the API key with all other clients; awaiting
+        thousands of reads at once is fine, as at most max_concurrency of
+        them are in flight at any time."""
+
+    def __init__(self, api_key, inst_token = None, num_res = None, local_dir = None,
+                 max_concurrency = 8, **kwargs):
+        """Initializes a client with a given API Key and, optionally,
+            institutional token, number of results per request, local data
+            path and max. number of concurrent requests. Other keyword
+            arguments are passed on to ElsClient; the connection pool is
+            sized to max_concurrency unless pool_maxsize is given."""
+        kwargs.setdefault('pool_maxsize', max_concurrency)
+        super().__init__(api_key, inst_token, num_res, local_dir, **kwargs)
+        self._max_concurrency = max_concurrency
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def max_concurrency(self):
+        """Gets the max. number of requests the client sends concurrently"""
+        return self._max_concurrency
+
+    def _get_executor(self):
+        """Returns the pool of worker threads, starting it if need be."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers = self._max_concurrency, thread_name_prefix = 'elsapy')
+            return self._executor
+
+    def close(self):
+        """Shuts down the client's worker threads and connection pool. The
+            client can still be used afterwards, but will have to start new
+            threads and open new connections."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait = False)
+                self._executor = None
+        super().close()
+
+    async def run_async(self, func, *args, **kwargs):
+        """Runs func (typically a blocking read or search) on one of the
+            client's worker threads and returns its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(), functools.partial(func, *args, **kwargs))
+
+    async def exec_request_async(self, URL):
+        """Sends the actual request without blocking the event loop; returns
+            response."""
+        return await self.run_async(self.exec_request, URL)
@@ -4,8 +4,11 @@
     * https://dev.elsevier.com
     * https://api.elsevier.com"""
 
+import requests, json
+from urllib.parse import quote_plus as url_encode
 from . import log_util
 from .elsentity import ElsEntity
+from .utils import chunked
 
 logger = log_util.get_logger(__name__)
 
@@ -15,6 +18,42 @@ class FullDoc(ElsEntity):
     # static variables
     __payload_type = u'full-text-retrieval-response'
     __uri_base = u'https://api.elsevier.com/content/article/'
+    _formats = {                                ## Accept type and file suffix
+        'json'  : ('application/json', '.response.json'),  ##  per format
+        'xml'   : ('text/xml', '.xml'),
+        'pdf'   : ('application/pdf', '.pdf'),
+        'text'  : ('text/plain', '.txt'),
+        }
+
+    @classmethod
+    def _from_id(cls, id):
+        """Returns a document for the given URI, DOI or ScienceDirect PII."""
+        if str(id).startswith('http'):
+            return cls(uri = id)
+        elif str(id).startswith('10.'):
+            return cls(doi = id)
+        else:
+            return cls(sd_pii = id)
+
+    @property
+    def data(self):
+        """Gets the full JSON data for the document. If it was read with
+            lazy = True, it is parsed from the downloaded file on first
+            access."""
+        if self._data is None and self._lazy_path:
+            with self._lazy_path.open() as lazy_file:
+                api_response = json.load(lazy_file)
+            if isinstance(api_response[self.__payload_type], list):
+                self._data = api_response[self.__payload_type][0]
+            else:
+                self._data = api_response[self.__payload_type]
+            self._lazy_path = None
+        return self._data
+
+    @property
+    def download_path(self):
+        """Gets the path of the file the document was last downloaded to"""
+        return self._download_path
 
     @property
     def title(self):
@@ -39,22 +78,72 @@ class FullDoc(ElsEntity):
             raise ValueError('No URI, ScienceDirect PII or DOI specified')
         else:
             raise ValueError('Multiple identifiers specified; just need one.')
+        self._download_path = None
+        self._lazy_path = None
 
     # modifier functions
-    def read(self, els_client = None):
+    def read(self, els_client = None, cache_policy = None, lazy = False):
         """Reads the JSON representation of the document from ELSAPI.
-             Returns True if successful; else, False."""
-        if super().read(self.__payload_type, els_client):
+             Returns True if successful; else, False. With lazy = True, the
+             JSON is streamed to a file in the client's local data path
+             instead (see download()), and only parsed, in full, when data
+             is first accessed. A lazy read always downloads the document,
+             so it cannot be combined with a cache policy other than
+             'network-only' or with conditional requests."""
+        if lazy:
+            client = els_client or self.client
+            if client and (client.conditional_requests
+                           or (cache_policy or client.cache_policy) != 'network-only'):
+                raise ValueError('Lazy reads require cache policy network-only'
+                                 ' and no conditional requests')
+            if self.download(accept = 'json', els_client = els_client):
+                self._data = None
+                self._lazy_path = self._download_path
+                return True
+            else:
+                return False
+        if super().read(self.__payload_type, els_client, cache_policy):
             return True
         else:
             return False
 
+    def download(self, path = None, accept = 'xml', els_client = None,
+                 chunk_size = 1024 * 1024):
+        """Downloads the full text of the document straight to a file, in
+             chunks of chunk_size bytes. Accept is 'json', 'xml', 'pdf' or
+             'text', or any other Accept type the API supports (in which case
+             path must be given). Path defaults to the url-encoded URI, with
+             a suffix for the format, in the client's local data path.
+             Returns True if successful; else, False."""
+        if els_client:
+            self._client = els_client;
+        elif not self.client:
+            raise ValueError('''Entity object not currently bound to els_client instance. Call .download() with els_client argument or set .client attribute.''')
+        if accept in self._formats:
+            accept, suffix = self._formats[accept]
+        elif not path:
+            raise ValueError('No path given for Accept type ' + accept)
+        if not path:
+            path = self.client.local_dir / (url_encode(self.uri) + suffix)
+        try:
+            self._download_path = self.client.exec_download(
+                self.uri, path, accept, chunk_size)
+            self._read_error = None
+            return True
+        except (requests.HTTPError, requests.RequestException) as e:
+            self._read_error = e
+            logger.warning(e.args)
+            return False
+
 class AbsDoc(ElsEntity):
     """A document in Scopus. Initialize with URI or Scopus ID."""
 
     # static variables
     __payload_type = u'abstracts-retrieval-response'
     __uri_base = u'https://api.elsevier.com/content/abstract/'
+    _id_arg = 'scp_id'
+    _batch_uri = u'https://api.elsevier.com/content/search/scopus?query='
+    _batch_size = 25        ## Max. number of EIDs per search request
 
     @property
     def title(self):
@@ -79,10 +168,48 @@ class AbsDoc(ElsEntity):
             raise ValueError('Both URI and Scopus ID specified; just need one.')    
 
     # modifier functions
-    def read(self, els_client = None):
+    def read(self, els_client = None, cache_policy = None):
         """Reads the JSON representation of the document from ELSAPI.
              Returns True if successful; else, False."""
-        if super().read(self.__payload_type, els_client):
+        if super().read(self.__payload_type, els_client, cache_policy):
             return True
         else:
-            return False
\ No newline at end of file
+            return False
+
+    @classmethod
+    def read_batch(cls, ids, els_client):
+        """Reads the documents with the given Scopus IDs or EIDs through the
+            Scopus Search API, packing up to 25 of them in each request with
+            an EID(... OR ...) query. Returns a list of AbsDoc objects in the
+            order of ids; documents that could not be read have no data.
+            NOTE: the data of each document is its search result record
+            (under 'coredata'), which has fewer fields than what read()
+            retrieves from the Abstract Retrieval API."""
+        eid_prefix = '2-s2.0-'
+        docs = []
+        for batch in chunked(ids, cls._batch_size):
+            eids = [str(id) if str(id).startswith(eid_prefix)
+                    else eid_prefix + str(id) for id in batch]
+            batch_docs = [cls(scp_id = eid[len(eid_prefix):]) for eid in eids]
+            docs += batch_docs
+            url = (cls._batch_uri + url_encode('EID(' + ' OR '.join(eids) + ')')
+                   + '&count=' + str(cls._batch_size))
+            try:
+                api_response = els_client.exec_request(url)
+            except (requests.HTTPError, requests.RequestException) as e:
+                logger.warning(e.args)
+                for doc in batch_docs:
+                    doc._read_error = e
+                continue
+            ## Split the response by the EIDs in the entries
+            by_eid = {entry['eid']: entry
+                      for entry in api_response['search-results']['entry']
+                      if 'eid' in entry}
+            for eid, doc in zip(eids, batch_docs):
+                doc.client = els_client
+                if eid in by_eid:
+                    doc._data = {'coredata': by_eid[eid]}
+                else:
+                    logger.warning('No data returned for ' + doc.uri)
+        logger.info('Read ' + str(len(docs)) + ' documents in batches')
+        return docs
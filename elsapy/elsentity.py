@@ -4,15 +4,25 @@
     * https://dev.elsevier.com
     * https://api.elsevier.com"""
 
-import requests, json, urllib
+import requests, time
 from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from . import log_util
 
 logger = log_util.get_logger(__name__)
 
+ReadResult = namedtuple('ReadResult', ['id', 'entity', 'error'])
+ReadResult.__doc__ = """The outcome of reading one entity with read_many(): the ID
+    it was requested by, the entity, and the error that made the read fail
+    (None if it succeeded)."""
+
 class ElsEntity(metaclass=ABCMeta):
     """An abstract class representing an entity in Elsevier's data model"""
 
+    # static variables
+    _id_arg = None          ## Name of the constructor argument for plain IDs
+
     # constructors
     @abstractmethod
     def __init__(self, uri):
@@ -20,6 +30,16 @@ class ElsEntity(metaclass=ABCMeta):
         self._uri = uri
         self._data = None
         self._client = None
+        self._read_error = None
+        self._validators = None
+
+    @classmethod
+    def _from_id(cls, id):
+        """Returns an entity instance for the given ID or URI."""
+        if str(id).startswith('http'):
+            return cls(uri = id)
+        else:
+            return cls(**{cls._id_arg: id})
 
     # properties
     @property
@@ -60,38 +80,181 @@ class ElsEntity(metaclass=ABCMeta):
 
     # modifier functions
     @abstractmethod
-    def read(self, payloadType, elsClient):
+    def read(self, payloadType, elsClient, cache_policy = None):
         """Fetches the latest data for this entity from api.elsevier.com.
-            Returns True if successful; else, False."""
+            Returns True if successful; else, False. If the client is set
+            up for conditional requests and the entity has been written
+            before, the local copy is used if it is still current.
+            Cache_policy ('network-only', 'local-first' or 'local-only')
+            overrides the client's cache policy; with a local policy, the
+            client's memory store and store are checked first."""
         if elsClient:
             self._client = elsClient;
         elif not self.client:
             raise ValueError('''Entity object not currently bound to elsClient instance. Call .read() with elsClient argument or set .client attribute.''')
+        if not cache_policy:
+            cache_policy = self.client.cache_policy
+        elif cache_policy not in self.client.cache_policies:
+            raise ValueError('Cache policy must be one of ' + ', '.join(self.client.cache_policies))
+        if cache_policy != 'network-only':
+            if self._read_local(any_age = (cache_policy == 'local-only')):
+                self._read_error = None
+                logger.info("Data loaded from local store for " + self.uri)
+                return True
+            elif cache_policy == 'local-only':
+                self._read_error = LookupError('No local data for ' + self.uri)
+                logger.warning(self._read_error.args[0])
+                return False
         try:
-            api_response = self.client.exec_request(self.uri)
-            if isinstance(api_response[payloadType], list):
+            if self.client.conditional_requests:
+                api_response = self._exec_conditional_request()
+            else:
+                api_response = self.client.exec_request(self.uri)
+            if api_response is None:
+                logger.info("Local data still current for " + self.uri)
+            elif isinstance(api_response[payloadType], list):
                 self._data = api_response[payloadType][0]
             else:
                 self._data = api_response[payloadType]
             ## TODO: check if URI is the same, if necessary update and log warning.
+            if cache_policy != 'network-only' and self.client.memory_store is not None:
+                self.client.memory_store.put(type(self).__name__, self.uri,
+                                             self._data, self._validators)
+            self._read_error = None
             logger.info("Data loaded for " + self.uri)
             return True
         except (requests.HTTPError, requests.RequestException) as e:
+            self._read_error = e
             for elm in e.args:
                 logger.warning(elm)
             return False
 
+    def _read_local(self, any_age = False):
+        """Loads the entity's data from the client's memory store or, failing
+            that, its store, if it is there and younger than the client's
+            max_age (or of any age, if any_age or max_age is None). Returns
+            True if the data was loaded; else, False."""
+        entity_type = type(self).__name__
+        memory_store = self.client.memory_store
+        stored = None
+        if memory_store is not None:
+            stored = memory_store.get(entity_type, self.uri)
+        if stored is None:
+            stored = self.client.store.get(entity_type, self.uri)
+            if stored is not None and memory_store is not None:
+                memory_store.put(entity_type, self.uri, *stored)
+        if stored is None:
+            return False
+        data, validators = stored
+        max_age = self.client.max_age
+        if (not any_age and max_age is not None
+                and time.time() - validators.get('fetched', 0) >= max_age):
+            return False
+        self._data = data
+        self._validators = validators
+        return True
+
+    def _exec_conditional_request(self):
+        """Requests the entity's data only if it has changed since it was
+            last written to the client's store, as per the validators
+            stored with it. Returns the API response, or None if the stored
+            copy is still current; in that case, it is loaded into
+            self.data."""
+        store = self.client.store
+        entity_type = type(self).__name__
+        stored = store.get(entity_type, self.uri)
+        if stored is None:
+            api_response, self._validators = self.client.exec_conditional_request(self.uri)
+            return api_response
+        local_data, validators = stored
+        if not (validators.get('etag') or validators.get('last_modified')):
+            ## The API gave no validators, so fall back to the local copy's age
+            max_age = self.client.max_age
+            if max_age and time.time() - validators.get('fetched', 0) < max_age:
+                self._data = local_data
+                self._validators = validators
+                return None
+        api_response, self._validators = self.client.exec_conditional_request(
+            self.uri, validators)
+        if api_response is None:
+            self._data = local_data
+            store.put_validators(entity_type, self.uri, self._validators)
+        return api_response
+
+    @classmethod
+    def read_many(cls, ids, els_client, workers = 4):
+        """Reads the entities with the given IDs (or URIs) on a pool of worker
+            threads, throttled by els_client's rate limiter. Yields a
+            ReadResult for each ID as soon as it is read, so results come in
+            order of completion rather than in the order of ids. A failed
+            read does not stop the others; its ReadResult holds the error."""
+        ids = iter(ids)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            pending = {}
+            def submit(n):
+                """Submits reads for the next n valid IDs (fewer if ids runs
+                    out); yields a ReadResult for each invalid ID skipped."""
+                if n <= 0:
+                    return
+                for id in ids:
+                    try:
+                        entity = cls._from_id(id)
+                    except ValueError as e:
+                        yield ReadResult(id, None, e)
+                        continue
+                    pending[executor.submit(entity.read, els_client)] = (id, entity)
+                    n -= 1
+                    if n == 0:
+                        return
+            ## Keep a bounded number of reads queued, so ids can be a huge
+            ##  (or lazy) sequence.
+            yield from submit(workers * 2)
+            while pending:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    id, entity = pending.pop(future)
+                    try:
+                        if future.result():
+                            yield ReadResult(id, entity, None)
+                        else:
+                            yield ReadResult(id, entity, entity._read_error)
+                    except Exception as e:
+                        yield ReadResult(id, entity, e)
+                    yield from submit(1)
+
+    async def read_async(self, els_client = None):
+        """Fetches the latest data for this entity from api.elsevier.com
+            without blocking the event loop; els_client (or the client the
+            entity is bound to) must be an AsyncElsClient. Returns True if
+            successful; else, False."""
+        client = els_client if els_client else self.client
+        if not client:
+            raise ValueError('''Entity object not currently bound to elsClient instance. Call .read_async() with elsClient argument or set .client attribute.''')
+        return await client.run_async(self.read, els_client)
+
     def write(self):
-        """If data exists for the entity, writes it to disk as a .JSON file with
-             the url-encoded URI as the filename and returns True. Else, returns
-             False."""
+        """If data exists for the entity, writes it to the client's store
+             (by default, to disk as a .JSON file with the url-encoded URI as
+             the filename) and returns True. Else, returns False. If the data
+             was read with a conditional request, the validators of the
+             response are stored with it (by default, in a .meta.json
+             file)."""
         if (self.data):
-            dataPath = self.client.local_dir / (urllib.parse.quote_plus(self.uri)+'.json')
-            with dataPath.open(mode='w') as dump_file:
-                json.dump(self.data, dump_file)
-                dump_file.close()
+            self.client.store.put(type(self).__name__, self.uri, self.data,
+                                  self._validators)
             logger.info('Wrote ' + self.uri + ' to file')
             return True
         else:
             logger.warning('No data to write for ' + self.uri)
-            return False
\ No newline at end of file
+            return False
+
+    @staticmethod
+    def write_many(entities, els_client):
+        """Writes the entities that have data to els_client's store in one
+             batch (a single transaction for a SqliteStore). Returns the
+             number of entities written."""
+        entries = [(type(entity).__name__, entity.uri, entity.data, entity._validators)
+                   for entity in entities if entity.data]
+        els_client.store.put_many(entries)
+        logger.info('Wrote ' + str(len(entries)) + ' entities')
+        return len(entries)
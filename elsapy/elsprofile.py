@@ -4,11 +4,13 @@
     * https://dev.elsevier.com
     * https://api.elsevier.com"""
 
-import requests, json, urllib, pandas as pd
+import requests, json, os, urllib, pandas as pd
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from . import log_util
 from .elsentity import ElsEntity
-from .utils import recast_df
+from .utils import recast_df, compact_df, chunked, open_compressed
 
 
 logger = log_util.get_logger(__name__)        
@@ -17,10 +19,14 @@ class ElsProfile(ElsEntity, metaclass=ABCMeta):
     """An abstract class representing an author or affiliation profile in
         Elsevier's data model"""
 
+    # class variables
+    _docs_suffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
     def __init__(self, uri):
         """Initializes a data entity with its URI"""
         super().__init__(uri)
         self._doc_list = None
+        self._docs_progress = None
 
 
     @property
@@ -28,11 +34,56 @@ class ElsProfile(ElsEntity, metaclass=ABCMeta):
         """Get the list of documents for this entity"""
         return self._doc_list
 
+    def _read_docs_page(self, payloadType, startref = None):
+        """Reads one page of the entity's document list, starting at the
+            startref-th document (1-based; the first page if None). Returns
+            the total number of documents and the documents on the page."""
+        url = self.uri + "?view=documents"
+        if startref:
+            url += "&startref=" + str(startref)
+        api_response = self.client.exec_request(url)
+        if isinstance(api_response[payloadType], list):
+            data = api_response[payloadType][0]
+        else:
+            data = api_response[payloadType]
+        return (int(data["documents"]["@total"]),
+                data["documents"].get("abstract-document", []))
+
+    def _iter_doc_pages(self, payloadType, doc_count, start, page_size, workers):
+        """Yields the pages of the document list after the first start
+            documents, in order. As the total number of documents and the
+            page size are known from the first page, the startref of every
+            page is known up front, so up to workers pages are fetched
+            concurrently, throttled by the client's rate limiter."""
+        if not page_size:
+            return
+        startrefs = iter(range(start + 1, doc_count + 1, page_size))
+        executor = ThreadPoolExecutor(max_workers = workers)
+        try:
+            window = deque(executor.submit(self._read_docs_page, payloadType, startref)
+                           for _, startref in zip(range(workers), startrefs))
+            while window:
+                total, page = window.popleft().result()
+                startref = next(startrefs, None)
+                if startref:
+                    window.append(executor.submit(
+                        self._read_docs_page, payloadType, startref))
+                if not page:
+                    break
+                yield page
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+
     @abstractmethod
-    def read_docs(self, payloadType, els_client = None):
+    def read_docs(self, payloadType, els_client = None, compact = False, workers = 4):
         """Fetches the list of documents associated with this entity from
             api.elsevier.com. If need be, splits the requests in batches to
-            retrieve them all. Returns True if successful; else, False.
+            retrieve them all; batches after the first are fetched by up to
+            workers concurrent requests. Returns True if successful; else,
+            False. If a batch fails (after the client's retries), the batches
+            read so far are kept, and the next call continues from there.
+            With compact = True, docsframe is made compact to save memory
+            (see utils.compact_df).
 			NOTE: this method requires elevated API permissions.
 			See http://bit.ly/2leirnq for more info."""
         if els_client:
@@ -40,52 +91,111 @@ class ElsProfile(ElsEntity, metaclass=ABCMeta):
         elif not self.client:
             raise ValueError('''Entity object not currently bound to els_client instance. Call .read() with els_client argument or set .client attribute.''')
         try:
-            api_response = self.client.exec_request(self.uri + "?view=documents")
-            if isinstance(api_response[payloadType], list):
-                data = api_response[payloadType][0]
+            if self._docs_progress:
+                docCount, page_size, doc_list = self._docs_progress
+                logger.info("Resuming document list for " + self.uri
+                            + " at " + str(len(doc_list)))
             else:
-                data = api_response[payloadType]
-            docCount = int(data["documents"]["@total"])
-            self._doc_list = [x for x in data["documents"]["abstract-document"]]
-            for i in range (0, docCount//self.client.num_res):
-                try:
-                    api_response = self.client.exec_request(self.uri + "?view=documents&startref=" + str((i+1) * self.client.num_res+1))
-                    if isinstance(api_response[payloadType], list):
-                        data = api_response[payloadType][0]
-                    else:
-                        data = api_response[payloadType]
-                    self._doc_list = self._doc_list + [x for x in data["documents"]["abstract-document"]]
-                except  (requests.HTTPError, requests.RequestException) as e:
-                    if hasattr(self, 'doc_list'):       ## We don't want incomplete doc lists
-                        self._doc_list = None
-                    raise e
+                docCount, doc_list = self._read_docs_page(payloadType)
+                page_size = len(doc_list)
+            try:
+                for page in self._iter_doc_pages(payloadType, docCount,
+                                                 len(doc_list), page_size, workers):
+                    doc_list.extend(page)
+            except  (requests.HTTPError, requests.RequestException) as e:
+                ## We don't want incomplete doc lists, but keep what we
+                ##  have so the next call doesn't have to start over.
+                self._doc_list = None
+                self._docs_progress = (docCount, page_size, doc_list)
+                logger.warning("Document list for " + self.uri + " incomplete at "
+                               + str(len(doc_list)) + " of " + str(docCount)
+                               + "; call read_docs() again to resume.")
+                raise e
+            self._docs_progress = None
+            self._doc_list = doc_list
             logger.info("Documents loaded for " + self.uri)
             self.docsframe = recast_df(pd.DataFrame(self._doc_list))
+            if compact:
+                self.docsframe = compact_df(self.docsframe)
             logger.info("Documents loaded into dataframe for " + self.uri)
             return True
         except (requests.HTTPError, requests.RequestException) as e:
             logger.warning(e.args)
             return False
 
-    def write_docs(self):
-        """If a doclist exists for the entity, writes it to disk as a JSON file
-             with the url-encoded URI as the filename and returns True. Else,
-             returns False."""
-        if self.doc_list:
-            dump_file = open('data/'
-                             + urllib.parse.quote_plus(self.uri+'?view=documents')
-                             + '.json', mode='w'
-                             )
-            dump_file.write('[' + json.dumps(self.doc_list[0]))
-            for i in range (1, len(self.doc_list)):
-                dump_file.write(',' + json.dumps(self.doc_list[i]))
-            dump_file.write(']')
-            dump_file.close()
-            logger.info('Wrote ' + self.uri + '?view=documents to file')
-            return True
+    def iter_docs(self, els_client = None, workers = 4):
+        """Lazily iterates over the documents associated with this entity,
+            yielding each document as soon as its page has been retrieved,
+            without storing the list or building a data frame. Up to workers
+            pages are fetched ahead of consumption. Raises requests.HTTPError
+            if a page cannot be retrieved.
+			NOTE: this method requires elevated API permissions.
+			See http://bit.ly/2leirnq for more info."""
+        if els_client:
+            self._client = els_client;
+        elif not self.client:
+            raise ValueError('''Entity object not currently bound to els_client instance. Call .iter_docs() with els_client argument or set .client attribute.''')
+        doc_count, page = self._read_docs_page(self._payload_type)
+        yield from page
+        for page in self._iter_doc_pages(self._payload_type, doc_count,
+                                         len(page), len(page), workers):
+            yield from page
+
+    def _docs_path(self, compress = None):
+        """Returns the path of the local file the document list is written
+            to, with the given compression."""
+        suffix = '.jsonl' + self._docs_suffixes[compress]
+        return self.client.local_dir / (
+            urllib.parse.quote_plus(self.uri + '?view=documents') + suffix)
+
+    def write_docs(self, compress = None, docs = None):
+        """If a doclist exists for the entity, writes it to disk as a JSON
+             Lines file (one document per line) in the client's local_dir,
+             with the url-encoded URI as the filename, and returns True. Else,
+             returns False. Compress can be 'gzip' (or True) or 'zstd' (which
+             requires zstandard). Documents are streamed to a temporary file
+             that is only renamed once complete. Docs, if given, is an
+             iterable of documents to write instead of the doclist, such as
+             iter_docs(), so that the list does not have to be held in
+             memory."""
+        if compress is True:
+            compress = 'gzip'
+        if compress not in self._docs_suffixes:
+            raise ValueError('Unknown compression: ' + str(compress))
+        if docs is None:
+            if not self.doc_list:
+                logger.warning('No doclist to write for ' + self.uri)
+                return False
+            docs = self.doc_list
+        dump_path = self._docs_path(compress)
+        ## Keep the suffix, which open_compressed() goes by
+        tmp_path = dump_path.with_name('.tmp-' + dump_path.name)
+        try:
+            with open_compressed(tmp_path, mode = 'wt') as dump_file:
+                for doc in docs:
+                    dump_file.write(json.dumps(doc) + '\n')
+            os.replace(str(tmp_path), str(dump_path))
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        logger.info('Wrote ' + self.uri + '?view=documents to file')
+        return True
+
+    def iter_written_docs(self):
+        """Lazily iterates over the documents in the doclist written to disk
+             by write_docs(), whatever its compression, one document at a
+             time. Raises FileNotFoundError if no doclist has been written."""
+        for compress in self._docs_suffixes:
+            dump_path = self._docs_path(compress)
+            if dump_path.exists():
+                break
         else:
-            logger.warning('No doclist to write for ' + self.uri)
-            return False
+            raise FileNotFoundError('No doclist written for ' + self.uri)
+        with open_compressed(dump_path) as dump_file:
+            for line in dump_file:
+                if line.strip():
+                    yield json.loads(line)
 
 
 class ElsAuthor(ElsProfile):
@@ -94,6 +204,16 @@ class ElsAuthor(ElsProfile):
     # static variables
     _payload_type = u'author-retrieval-response'
     _uri_base = u'https://api.elsevier.com/content/author/author_id/'
+    _id_arg = 'author_id'
+    _batch_uri = u'https://api.elsevier.com/content/author?author_id='
+    _batch_size = 25        ## Max. number of author IDs per request
+    _metrics_fields = [
+            "document-count",
+            "cited-by-count",
+            "citation-count",
+            "h-index",
+            "dc:identifier",
+            ]
 
     # constructors
     def __init__(self, uri = '', author_id = ''):
@@ -124,49 +244,116 @@ class ElsAuthor(ElsProfile):
         return self.first_name + " " + self.last_name    
 
     # modifier functions
-    def read(self, els_client = None):
+    def read(self, els_client = None, cache_policy = None):
         """Reads the JSON representation of the author from ELSAPI.
             Returns True if successful; else, False."""
-        if ElsProfile.read(self, self._payload_type, els_client):
+        if ElsProfile.read(self, self._payload_type, els_client, cache_policy):
             return True
         else:
             return False
 
-    def read_docs(self, els_client = None):
+    def read_docs(self, els_client = None, compact = False, workers = 4):
         """Fetches the list of documents associated with this author from 
              api.elsevier.com. Returns True if successful; else, False."""
-        return ElsProfile.read_docs(self, self._payload_type, els_client)
+        return ElsProfile.read_docs(self, self._payload_type, els_client,
+                                    compact, workers)
 
     def read_metrics(self, els_client = None):
         """Reads the bibliographic metrics for this author from api.elsevier.com
              and updates self.data with them. Returns True if successful; else,
              False."""
         try:
-            fields = [
-                    "document-count",
-                    "cited-by-count",
-                    "citation-count",
-                    "h-index",
-                    "dc:identifier",
-                    ]
             api_response = els_client.exec_request(
-                    self.uri + "?field=" + ",".join(fields))
+                    self.uri + "?field=" + ",".join(self._metrics_fields))
             data = api_response[self._payload_type][0]
-            if not self.data:
-                self._data = dict()
-                self._data['coredata'] = dict()
-            # TODO: apply decorator for type conversion of common fields
-            self._data['coredata']['dc:identifier'] = data['coredata']['dc:identifier']
-            self._data['coredata']['citation-count'] = int(data['coredata']['citation-count'])
-            self._data['coredata']['cited-by-count'] = int(data['coredata']['citation-count'])
-            self._data['coredata']['document-count'] = int(data['coredata']['document-count'])
-            self._data['h-index'] = int(data['h-index'])
-            logger.info('Added/updated author metrics')
+            self._set_metrics(data)
         except (requests.HTTPError, requests.RequestException) as e:
             logger.warning(e.args)
             return False
         return True
 
+    def _set_metrics(self, data):
+        """Updates self.data with the metrics in an author API response."""
+        if not self.data:
+            self._data = dict()
+            self._data['coredata'] = dict()
+        # TODO: apply decorator for type conversion of common fields
+        self._data['coredata']['dc:identifier'] = data['coredata']['dc:identifier']
+        self._data['coredata']['citation-count'] = int(data['coredata']['citation-count'])
+        self._data['coredata']['cited-by-count'] = int(data['coredata']['citation-count'])
+        self._data['coredata']['document-count'] = int(data['coredata']['document-count'])
+        self._data['h-index'] = int(data['h-index'])
+        logger.info('Added/updated author metrics')
+
+    @classmethod
+    def _read_batches(cls, ids, els_client, fields = None):
+        """Reads authors by author ID, packing up to _batch_size IDs in each
+            request. Yields an (author, data) pair per ID, where data is None
+            if the author could not be read. If fields are given,
+            dc:identifier is always added to them, as responses are matched
+            to authors by it."""
+        for batch in chunked(ids, cls._batch_size):
+            authors = [cls(author_id = id) for id in batch]
+            url = cls._batch_uri + ",".join(str(id) for id in batch)
+            if fields:
+                if "dc:identifier" not in fields:
+                    fields = list(fields) + ["dc:identifier"]
+                url += "&field=" + ",".join(fields)
+            try:
+                api_response = els_client.exec_request(url)
+            except (requests.HTTPError, requests.RequestException) as e:
+                logger.warning(e.args)
+                for author in authors:
+                    author._read_error = e
+                    yield author, None
+                continue
+            if 'author-retrieval-response-list' in api_response:
+                entries = api_response['author-retrieval-response-list'][cls._payload_type]
+            else:
+                entries = api_response[cls._payload_type]
+            if isinstance(entries, dict):
+                entries = [entries]
+            ## Split the response by the author IDs in the entries
+            by_id = dict()
+            for entry in entries:
+                if 'coredata' in entry:
+                    dc_id = entry['coredata']['dc:identifier']
+                    by_id[dc_id[dc_id.find(':') + 1:]] = entry
+            for id, author in zip(batch, authors):
+                author.client = els_client
+                data = by_id.get(str(id))
+                if not data:
+                    logger.warning('No data returned for ' + author.uri)
+                yield author, data
+
+    @classmethod
+    def read_batch(cls, ids, els_client, fields = None):
+        """Reads the authors with the given author IDs, packing up to 25 IDs
+            in each request. If fields is given, only those fields (and
+            dc:identifier) are retrieved. Returns a list of ElsAuthor objects
+            in the order of ids; authors that could not be read have no
+            data."""
+        authors = []
+        for author, data in cls._read_batches(ids, els_client, fields):
+            author._data = data
+            authors.append(author)
+        logger.info('Read ' + str(len(authors)) + ' authors in batches')
+        return authors
+
+    @classmethod
+    def read_metrics_batch(cls, ids, els_client):
+        """Reads the bibliographic metrics for the authors with the given
+            author IDs, packing up to 25 IDs in each request. Returns a list
+            of ElsAuthor objects in the order of ids, with the same metrics
+            in their data as read_metrics() adds; authors whose metrics could
+            not be read have no data."""
+        authors = []
+        for author, data in cls._read_batches(ids, els_client, cls._metrics_fields):
+            if data:
+                author._set_metrics(data)
+            authors.append(author)
+        return authors
+
         
 class ElsAffil(ElsProfile):
     """An affilliation (i.e. an institution an author is affiliated with) in Scopus.
@@ -175,6 +362,7 @@ class ElsAffil(ElsProfile):
     # static variables
     _payload_type = u'affiliation-retrieval-response'
     _uri_base = u'https://api.elsevier.com/content/affiliation/affiliation_id/'
+    _id_arg = 'affil_id'
 
     # constructors
     def __init__(self, uri = '', affil_id = ''):
@@ -195,15 +383,16 @@ class ElsAffil(ElsProfile):
         return self.data["affiliation-name"];     
 
     # modifier functions
-    def read(self, els_client = None):
+    def read(self, els_client = None, cache_policy = None):
         """Reads the JSON representation of the affiliation from ELSAPI.
              Returns True if successful; else, False."""
-        if ElsProfile.read(self, self._payload_type, els_client):
+        if ElsProfile.read(self, self._payload_type, els_client, cache_policy):
             return True
         else:
             return False
 
-    def read_docs(self, els_client = None):
+    def read_docs(self, els_client = None, compact = False, workers = 4):
         """Fetches the list of documents associated with this affiliation from
               api.elsevier.com. Returns True if successful; else, False."""
-        return ElsProfile.read_docs(self, self._payload_type, els_client)
+        return ElsProfile.read_docs(self, self._payload_type, els_client,
+                                    compact, workers)
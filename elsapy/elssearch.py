@@ -6,8 +6,11 @@
 
 from . import log_util
 from urllib.parse import quote_plus as url_encode
-import pandas as pd, json
-from .utils import recast_df
+import pandas as pd, datetime, json, os, queue, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .utils import recast_df, compact_df
+from .sinks import CallbackSink
 
 logger = log_util.get_logger(__name__)
 
@@ -20,6 +23,14 @@ class ElsSearch():
     _cursored_indexes = [
         'scopus',
     ]
+    _max_offset = 5000      ## Max. number of results reachable with start=
+    _year_clauses = {       ## Query clauses to restrict results to a year range
+        'scopus'        : 'PUBYEAR > {} AND PUBYEAR < {}',
+        'sciencedirect' : 'pub-date > {} AND pub-date < {}',
+    }
+    _subject_clause = 'SUBJAREA({})'
+    _count_cache = {}       ## Result counts by index and query
+    _count_cache_lock = threading.Lock()
 
     def __init__(self, query, index):
         """Initializes a search object with a query and target index."""
@@ -75,15 +86,18 @@ class ElsSearch():
         """Gets the request uri for the search"""
         return self._uri
 
-    def _upper_limit_reached(self):
+    def _upper_limit_reached(self, num_res = None):
         """Determines if the upper limit for retrieving results from of the
-            search index is reached. Returns True if so, else False. Upper 
-            limit is 5,000 for indexes that don't support cursor-based 
-            pagination."""
+            search index is reached, given the number of results retrieved
+            so far (by default, the number stored in the search object).
+            Returns True if so, else False. Upper limit is 5,000 for indexes
+            that don't support cursor-based pagination."""
         if self._cursor_supported:
             return False
-        else:
+        elif num_res is None:
             return self.num_res >= 5000
+        else:
+            return num_res >= 5000
 
     
     def execute(
@@ -92,34 +106,505 @@ class ElsSearch():
             get_all = False,
             use_cursor = False,
             view = None,
-            count = 25,
-            fields = []
+            count = None,
+            fields = [],
+            sink = None,
+            workers = 1,
+            checkpoint = None,
+            resume = None,
+            compact = False
         ):
         """Executes the search. If get_all = False (default), this retrieves
             the default number of results specified for the API. If
             get_all = True, multiple API calls will be made to iteratively get 
-            all results for the search, up to a maximum of 5,000."""
+            all results for the search, up to a maximum of 5,000. Each call
+            retrieves count results (by default, the client's page size for
+            the index and view; see ElsClient.page_size), restricted to the
+            given fields, if any. If a sink
+            (see elsapy.sinks) or a function is given, each page of results
+            is also passed to it as soon as it is retrieved; the sink is not
+            closed afterwards. If workers > 1 and no cursor is used, the
+            pages after the first are fetched concurrently by that many
+            threads.
+            If a checkpoint path is given, the position in the results and
+            the results retrieved so far are saved there after each page
+            (the latter in a .results.jsonl file next to it), and pages are
+            fetched one by one. If the search is interrupted, calling
+            execute() with resume set to that path continues where it
+            stopped, without fetching earlier pages again, with the get_all,
+            use_cursor and view it was started with; the sink, if any, only
+            gets the pages fetched after resuming.
+            With compact = True, results_df is made compact to save memory
+            (see utils.compact_df)."""
         ## TODO: add exception handling
+        if sink is not None and callable(sink):
+            sink = CallbackSink(sink)
+        url = None
+        num_res = 0
+        self._results = []
+        if resume:
+            checkpoint = resume
+            state = self._load_checkpoint(resume)
+            url = state['next_url']
+            num_res = state['num_res']
+            get_all = state.get('get_all', get_all)
+            use_cursor = state.get('use_cursor', use_cursor)
+            view = state.get('view', view)
+            self._tot_num_res = state['tot_num_res']
+        if checkpoint:
+            workers = 1
+            results_file = open(str(checkpoint) + '.results.jsonl',
+                                'a' if resume else 'w', encoding = 'utf-8')
+        try:
+            if not resume or url:
+                for page in self._iter_pages(els_client, get_all, use_cursor,
+                                             view, workers, url, num_res,
+                                             count, fields):
+                    if sink is not None:
+                        sink.write(page)
+                    self._results += page
+                    if checkpoint:
+                        for result in page:
+                            results_file.write(json.dumps(result) + '\n')
+                        results_file.flush()
+                        self._save_checkpoint(checkpoint, results_file.tell(),
+                                              get_all, use_cursor, view)
+        finally:
+            if checkpoint:
+                results_file.close()
+        self.results_df = recast_df(pd.DataFrame(self._results))
+        if compact:
+            self.results_df = compact_df(self.results_df)
+
+    async def execute_async(self, els_client, **kwargs):
+        """Executes the search without blocking the event loop; els_client
+            must be an AsyncElsClient. Takes the same keyword arguments as
+            execute()."""
+        return await els_client.run_async(self.execute, els_client, **kwargs)
+
+    def _page_url(self, els_client, use_cursor = False, view = None,
+                  count = None, fields = None):
+        """Returns the URL of the first page of results for the search, with
+            the page size the client picks for the index, view and count."""
         url = self._uri
         if use_cursor:
             url += "&cursor=*"
         if view:
             url += "&view={}".format(view)
-        api_response = els_client.exec_request(url)
-        self._tot_num_res = int(api_response['search-results']['opensearch:totalResults'])
-        self._results = api_response['search-results']['entry']
-        if get_all is True:
-            while (self.num_res < self.tot_num_res) and not self._upper_limit_reached():
+        url += "&count={}".format(els_client.page_size(self.index, view, count))
+        if fields:
+            url += "&field={}".format(','.join(fields))
+        return url
+
+    def _iter_pages(self, els_client, get_all, use_cursor, view, workers = 1,
+                    url = None, num_res = 0, count = None, fields = None):
+        """Yields the pages of results for the search, following the 'next'
+            link of each page only once the previous page has been consumed.
+            Stops after the first page unless get_all = True. If workers > 1
+            and no cursor is used, the remaining pages are fetched
+            concurrently instead (see _iter_offset_pages). If url is given,
+            starts from that page, counting num_res results before it; else,
+            from the first page, of count results with the given fields.
+            While pages are fetched one by one, self._next_url holds the URL
+            of the page after the one last yielded (None after the last)."""
+        if not url:
+            url = self._page_url(els_client, use_cursor, view, count, fields)
+        first_url = url
+        while url:
+            api_response = els_client.exec_request(url)
+            self._tot_num_res = int(api_response['search-results']['opensearch:totalResults'])
+            page = api_response['search-results'].get('entry', [])
+            num_res += len(page)
+            self._num_res_fetched = num_res
+            self._next_url = None
+            ## Without a cursor, no index serves results beyond start=5000
+            if (get_all and page and num_res < self.tot_num_res
+                    and not self._upper_limit_reached(num_res)
+                    and (use_cursor or num_res < self._max_offset)):
                 for e in api_response['search-results']['link']:
                     if e['@ref'] == 'next':
-                        next_url = e['@href']
-                api_response = els_client.exec_request(next_url)
-                self._results += api_response['search-results']['entry']
-        with open('dump.json', 'w') as f:
-            f.write(json.dumps(self._results))
-        self.results_df = recast_df(pd.DataFrame(self._results))
+                        self._next_url = e['@href']
+            yield page
+            if (self._next_url and workers > 1 and not use_cursor
+                    and url == first_url and num_res == len(page)):
+                self._next_url = None
+                yield from self._iter_offset_pages(
+                    els_client, first_url, len(page), workers)
+                break
+            url = self._next_url
+
+    def _save_checkpoint(self, path, results_size, get_all = False,
+                         use_cursor = False, view = None):
+        """Saves the search's position in its results to a checkpoint file,
+            along with the size of its results file and the options the
+            search was executed with."""
+        state = {
+            'query'         : self.query,
+            'index'         : self.index,
+            'get_all'       : get_all,
+            'use_cursor'    : use_cursor,
+            'view'          : view,
+            'next_url'      : self._next_url,
+            'num_res'       : self._num_res_fetched,
+            'tot_num_res'   : self.tot_num_res,
+            'results_size'  : results_size,
+            }
+        tmp_path = str(path) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, str(path))
+
+    def _load_checkpoint(self, path):
+        """Loads a checkpoint file saved by _save_checkpoint() and the results
+            saved with it into self._results; returns the checkpoint."""
+        with open(str(path)) as f:
+            state = json.load(f)
+        if state['query'] != self.query or state['index'] != self.index:
+            raise ValueError('Checkpoint ' + str(path) + ' is for a different search')
+        results_path = str(path) + '.results.jsonl'
+        ## Drop results written after the checkpoint was last saved
+        with open(results_path, 'r+b') as f:
+            f.truncate(state['results_size'])
+        with open(results_path, encoding = 'utf-8') as f:
+            self._results = [json.loads(line) for line in f]
+        logger.info('Resuming ' + self.query + ' after ' + str(state['num_res'])
+                    + ' results')
+        return state
+
+    def _iter_offset_pages(self, els_client, url, page_size, workers):
+        """Yields the pages after the first one (of page_size results) for a
+            search without cursor, in order. As the total number of results
+            is known from the first page, the offset (start=) of every page
+            is known up front, so up to workers pages are fetched
+            concurrently, ahead of consumption, throttled by the client's
+            rate limiter. Offsets are limited to the first 5,000 results."""
+        end = min(self.tot_num_res, self._max_offset)
+        urls = (url + "&start=" + str(start)
+                for start in range(page_size, end, page_size))
+        executor = ThreadPoolExecutor(max_workers = workers)
+        try:
+            window = deque(executor.submit(els_client.exec_request, page_url)
+                           for _, page_url in zip(range(workers), urls))
+            while window:
+                api_response = window.popleft().result()
+                page_url = next(urls, None)
+                if page_url:
+                    window.append(executor.submit(els_client.exec_request, page_url))
+                yield api_response['search-results'].get('entry', [])
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+
+    def iter_results(self, els_client, use_cursor = False, view = None,
+                     pages = False, workers = 1, count = None, fields = None):
+        """Lazily iterates over all results for the search (up to a maximum
+            of 5,000 for indexes that don't support cursor-based pagination),
+            yielding each result as soon as its page has been retrieved; with
+            pages = True, yields each page as a list of results instead. The
+            next page is only requested once the previous one has been
+            consumed, so results can be processed in constant memory and
+            iteration can be stopped early. Results are not stored in the
+            search object. If workers > 1 and no cursor is used, pages are
+            fetched concurrently, ahead of consumption, but still yielded in
+            order. Count and fields are as for execute()."""
+        for page in self._iter_pages(els_client, True, use_cursor, view, workers,
+                                     count = count, fields = fields):
+            if pages:
+                yield page
+            else:
+                yield from page
+
+    def _count(self, els_client, query, refresh = False):
+        """Returns the number of results for a query in the search's index,
+            retrieving a single, minimal result to find out. Counts are
+            cached per index and query for the lifetime of the process,
+            unless refresh = True."""
+        key = (self.index, query)
+        if not refresh:
+            with self._count_cache_lock:
+                if key in self._count_cache:
+                    return self._count_cache[key]
+        url = (self._base_url + self.index + '?query=' + url_encode(query)
+               + '&count=1&field=dc:identifier')
+        api_response = els_client.exec_request(url)
+        num_res = int(api_response['search-results']['opensearch:totalResults'])
+        with self._count_cache_lock:
+            self._count_cache[key] = num_res
+        return num_res
+
+    def count(self, els_client, refresh = False):
+        """Returns the number of results that exist in the index for the
+            query (also available as tot_num_res afterwards), without
+            retrieving them: only a single result with a single field is
+            requested. Counts are cached per index and query string, unless
+            refresh = True."""
+        self._tot_num_res = self._count(els_client, self.query, refresh)
+        return self._tot_num_res
+
+    @classmethod
+    def count_many(cls, queries, index, els_client, workers = 4, refresh = False):
+        """Returns a dict with the number of results for each of the given
+            queries in an index, counted as by count() on a pool of worker
+            threads, throttled by the client's rate limiter."""
+        searches = [cls(query, index) for query in queries]
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            counts = executor.map(
+                lambda search: search.count(els_client, refresh), searches)
+            return dict(zip([search.query for search in searches], counts))
+
+    def _partition(self, els_client, first_year, last_year, subject_areas):
+        """Splits the search's query by publication year range, recursively,
+            until each slice has at most 5,000 results. Slices of a single
+            year that are still too large are split by subject area, if
+            any are given. Returns a list of (search, use_cursor) pairs, one
+            per slice; use_cursor is True for slices that are too large to
+            retrieve without a cursor, if the index supports one."""
+        if self.index not in self._year_clauses:
+            raise ValueError('Partitioning is not supported for the '
+                             + self.index + ' index')
+        slices = []
+        def split(query, from_year, to_year):
+            ## Year clauses use strict comparisons, hence the -1/+1
+            slice_query = ('(' + query + ') AND ' + self._year_clauses[
+                self.index].format(from_year - 1, to_year + 1))
+            num_res = self._count(els_client, slice_query)
+            if num_res == 0:
+                return
+            elif num_res <= self._max_offset:
+                slices.append((ElsSearch(slice_query, self.index), False))
+            elif from_year < to_year:
+                mid_year = (from_year + to_year) // 2
+                split(query, from_year, mid_year)
+                split(query, mid_year + 1, to_year)
+            elif subject_areas and query == self.query:
+                for subject_area in subject_areas:
+                    split('(' + self.query + ') AND '
+                          + self._subject_clause.format(subject_area),
+                          from_year, to_year)
+            elif self._cursor_supported:
+                logger.info('Slice ' + slice_query + ' has ' + str(num_res)
+                            + ' results; retrieving it with a cursor')
+                slices.append((ElsSearch(slice_query, self.index), True))
+            else:
+                logger.warning('Slice ' + slice_query + ' has ' + str(num_res)
+                               + ' results; only 5,000 can be retrieved')
+                slices.append((ElsSearch(slice_query, self.index), False))
+        split(self.query, first_year, last_year)
+        return slices
+
+    def iter_partitioned(
+            self,
+            els_client,
+            first_year = 1900,
+            last_year = None,
+            subject_areas = None,
+            view = None,
+            workers = 4,
+            count = None,
+            fields = None
+        ):
+        """Lazily iterates over all results for the search, beyond the limit
+            of 5,000 results for indexes without cursor-based pagination.
+            The query is split into slices by publication year range
+            (first_year to last_year, by default next year) and, if need be,
+            by subject area (a list of subject area codes; Scopus only),
+            using cheap count-only requests, until each slice has at most
+            5,000 results (single-year slices that are still larger are
+            retrieved with a cursor, if the index supports one). The slices
+            are then retrieved by workers threads in parallel, and each
+            result is yielded once, de-duplicated by EID (or dc:identifier).
+            Results without a publication year in the range are not
+            retrieved. View, count and fields are as for execute(); to
+            de-duplicate, fields must include eid or dc:identifier. Searches
+            with at most 5,000 results are not split (nor limited to the
+            year range)."""
+        if last_year is None:
+            last_year = datetime.date.today().year + 1
+        if self.count(els_client) <= self._max_offset:
+            slices = [(ElsSearch(self.query, self.index), False)]
+        else:
+            slices = self._partition(els_client, first_year, last_year, subject_areas)
+            logger.info('Split ' + self.query + ' into ' + str(len(slices))
+                        + ' slices')
+        pages = queue.Queue(maxsize = workers * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            """Queues an item, unless the iteration has been stopped."""
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout = 0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def run(search, use_cursor):
+            """Retrieves the results of a slice and queues them page by page."""
+            try:
+                for page in search._iter_pages(els_client, True, use_cursor, view,
+                                               count = count, fields = fields):
+                    if not put(page):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        seen = set()
+        executor = ThreadPoolExecutor(max_workers = workers)
+        try:
+            for search, use_cursor in slices:
+                executor.submit(run, search, use_cursor)
+            running = len(slices)
+            while running:
+                item = pages.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for result in item:
+                        key = result.get('eid', result.get('dc:identifier'))
+                        if key is not None:
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                        yield result
+        finally:
+            stop.set()
+            executor.shutdown(wait = True, cancel_futures = True)
 
     def hasAllResults(self):
         """Returns true if the search object has retrieved all results for the
             query from the index (i.e. num_res equals tot_num_res)."""
         return (self.num_res is self.tot_num_res)
+
+
+class SearchBatch():
+    """Runs many searches concurrently against one client, and merges their
+        results into a single store, de-duplicated by EID (or dc:identifier),
+        that records which queries matched each result. Searches with the
+        same query and index are only run once."""
+
+    def __init__(self, searches):
+        """Initializes a batch with a list of ElsSearch objects."""
+        self._searches = list(searches)
+        self._records = dict()
+        self._matches = dict()
+        self._progress = {(search.index, search.query): {
+                                'status': 'pending', 'num_res': 0,
+                                'tot_num_res': None, 'error': None}
+                          for search in self._searches}
+        self._lock = threading.Lock()
+
+    # properties
+    @property
+    def searches(self):
+        """Gets the searches in the batch"""
+        return self._searches
+
+    @property
+    def records(self):
+        """Gets the de-duplicated results of all searches, as a dict keyed
+            by EID (or dc:identifier)"""
+        return self._records
+
+    @property
+    def matches(self):
+        """Gets the queries that matched each result, as a dict of lists
+            keyed by EID (or dc:identifier)"""
+        return {key: sorted(queries) for key, queries in self._matches.items()}
+
+    @property
+    def progress(self):
+        """Gets the progress of each search, as a dict keyed by (index,
+            query) with its status ('pending', 'running', 'done' or
+            'failed'), number of results retrieved, total number of results
+            and error, if any"""
+        with self._lock:
+            return {key: dict(p) for key, p in self._progress.items()}
+
+    @property
+    def results_df(self):
+        """Gets the de-duplicated results as a data frame, with the queries
+            that matched each result in the 'matched_queries' column"""
+        matches = self.matches
+        df = pd.DataFrame(list(self._records.values()))
+        df['matched_queries'] = [matches[key] for key in self._records]
+        return recast_df(df)
+
+    def _merge(self, search, page):
+        """Merges a page of results for a search into the store. Results
+            without an EID or dc:identifier cannot be merged, and are
+            skipped."""
+        merged = 0
+        with self._lock:
+            for result in page:
+                if 'error' in result:           ## E.g. 'Result set was empty'
+                    continue
+                key = result.get('eid', result.get('dc:identifier'))
+                if key is None:
+                    logger.warning('Skipping result without EID or dc:identifier'
+                                   + ' for ' + search.query)
+                    continue
+                if key not in self._records:
+                    self._records[key] = result
+                    self._matches[key] = set()
+                self._matches[key].add(search.query)
+                merged += 1
+            self._progress[(search.index, search.query)]['num_res'] += merged
+
+    def _run(self, search, els_client, callback, kwargs):
+        """Runs a search and merges its results."""
+        key = (search.index, search.query)
+        with self._lock:
+            self._progress[key]['status'] = 'running'
+        try:
+            for page in search._iter_pages(els_client, **kwargs):
+                self._merge(search, page)
+                with self._lock:
+                    self._progress[key]['tot_num_res'] = search.tot_num_res
+                    progress = dict(self._progress[key])
+                if callback:
+                    callback(key, progress)
+            status, error = 'done', None
+        except Exception as e:
+            logger.warning('Search ' + search.query + ' failed: ' + str(e))
+            status, error = 'failed', e
+        with self._lock:
+            self._progress[key]['status'] = status
+            self._progress[key]['error'] = error
+            progress = dict(self._progress[key])
+        if callback:
+            callback(key, progress)
+
+    def execute(
+            self,
+            els_client,
+            get_all = False,
+            use_cursor = False,
+            view = None,
+            count = None,
+            fields = None,
+            workers = 4,
+            callback = None
+        ):
+        """Executes the searches in the batch on a pool of worker threads,
+            throttled by the client's rate limiter; get_all, use_cursor,
+            view, count and fields are as for ElsSearch.execute(). A failed
+            search does not stop the others; its error is recorded in
+            progress. If a callback is given, it is called with each search's
+            (index, query) and progress after every page. Returns True if all
+            searches succeeded; else, False."""
+        ## Run identical searches only once
+        searches = dict()
+        for search in self._searches:
+            searches.setdefault((search.index, search.query), search)
+        kwargs = {'get_all': get_all, 'use_cursor': use_cursor, 'view': view,
+                  'count': count, 'fields': fields}
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            for search in searches.values():
+                executor.submit(self._run, search, els_client, callback, kwargs)
+        logger.info('Executed ' + str(len(searches)) + ' searches; '
+                    + str(len(self._records)) + ' unique results')
+        return all(p['status'] == 'done' for p in self.progress.values())
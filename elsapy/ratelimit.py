@@ -0,0 +1,157 @@
+"""The rate limiting module of elsapy. Used by elsclient.
+    Additional resources:
+    * https://github.com/ElsevierDev/elsapy
+    * https://dev.elsevier.com
+    * https://api.elsevier.com"""
+
+import time, threading
+from urllib.parse import urlparse
+from . import log_util
+
+logger = log_util.get_logger(__name__)
+
+
+def endpoint_family(url):
+    """Returns the family of API endpoints a URL belongs to, i.e. 'search',
+        'abstract', 'author', 'affiliation' or 'article'; 'default' for
+        anything else."""
+    segments = [s for s in urlparse(url).path.split('/') if s]
+    if 'content' in segments:
+        i = segments.index('content')
+        if i + 1 < len(segments):
+            family = segments[i + 1]
+            if family in RateLimiter.default_rates:
+                return family
+    return 'default'
+
+
+class TokenBucket:
+    """A token bucket that refills at a given rate (in requests per second)
+        and allows bursts of up to capacity requests. Safe to share between
+        threads."""
+
+    def __init__(self, rate, capacity = None):
+        """Initializes a full bucket with the given rate and capacity. The
+            capacity defaults to the rate, i.e. one second's worth of
+            requests."""
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self._tokens = self.capacity
+        self._ts_last_fill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _fill(self):
+        """Adds the tokens that have accrued since the last fill."""
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._ts_last_fill) * self.rate)
+        self._ts_last_fill = now
+
+    def acquire(self):
+        """Takes a token from the bucket, sleeping until it is available. A
+            token that is not available yet is reserved before sleeping, so
+            that concurrent callers queue up behind each other instead of
+            all waking up at the same time."""
+        with self._lock:
+            self._fill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Throttles requests to api.elsevier.com with a token bucket per endpoint
+        family, and keeps track of the quota reported by the API through the
+        X-RateLimit-* response headers.
+
+        Note that X-RateLimit-Limit is the weekly quota for the API key, not a
+        rate: the per-second rates are set per family (see default_rates) and
+        can be raised to whatever has been agreed for the API key. Any object
+        with acquire(url) and update(url, headers) methods can be passed to
+        ElsClient instead of an instance of this class.
+
+        Rate limiters are thread-safe. Use RateLimiter.for_key() to get the
+        limiter that all clients in the process share for an API key."""
+
+    # class variables
+    default_rates = {                           ## Requests per second
+        'search'        : 6,
+        'abstract'      : 9,
+        'author'        : 3,
+        'affiliation'   : 3,
+        'article'       : 10,
+        'default'       : 1,
+    }
+    _shared = {}                                ## Shared limiters per API key
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rates = None):
+        """Initializes a rate limiter. Rates, if given, is a dict of requests
+            per second per endpoint family that overrides default_rates."""
+        self._rates = dict(self.default_rates)
+        if rates:
+            self._rates.update(rates)
+        self._buckets = {}
+        self._quota = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_key(cls, api_key):
+        """Returns the process-wide rate limiter for an API key, creating it
+            with the default rates if need be."""
+        with cls._shared_lock:
+            if api_key not in cls._shared:
+                cls._shared[api_key] = cls()
+            return cls._shared[api_key]
+
+    # properties
+    @property
+    def rates(self):
+        """Gets the requests per second allowed per endpoint family"""
+        return dict(self._rates)
+
+    @property
+    def quota(self):
+        """Gets the quota last reported by the API per endpoint family, as a
+            dict with 'limit', 'remaining' and 'reset' (a Unix timestamp)"""
+        with self._lock:
+            return {family: dict(quota) for family, quota in self._quota.items()}
+
+    def set_rate(self, family, rate):
+        """Sets the requests per second allowed for an endpoint family"""
+        with self._lock:
+            self._rates[family] = rate
+            self._buckets.pop(family, None)
+
+    def _bucket(self, family):
+        """Returns the token bucket for an endpoint family."""
+        with self._lock:
+            if family not in self._buckets:
+                self._buckets[family] = TokenBucket(
+                    self._rates.get(family, self._rates['default']))
+            return self._buckets[family]
+
+    def acquire(self, url):
+        """Blocks until a request to the given URL is allowed."""
+        family = endpoint_family(url)
+        with self._lock:
+            quota = self._quota.get(family)
+        if quota and quota['remaining'] == 0 and quota['reset'] > time.time():
+            logger.warning('Quota for ' + family + ' requests exhausted until '
+                           + time.ctime(quota['reset']))
+        self._bucket(family).acquire()
+
+    def update(self, url, headers):
+        """Records the quota reported in the headers of a response to a
+            request to the given URL."""
+        try:
+            quota = {
+                'limit'     : int(headers['X-RateLimit-Limit']),
+                'remaining' : int(headers['X-RateLimit-Remaining']),
+                'reset'     : float(headers['X-RateLimit-Reset']),
+            }
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self._quota[endpoint_family(url)] = quota
@@ -0,0 +1,94 @@
+"""The retry module of elsapy. Used by elsclient.
+    Additional resources:
+    * https://github.com/ElsevierDev/elsapy
+    * https://dev.elsevier.com
+    * https://api.elsevier.com"""
+
+import random, threading, time
+from email.utils import parsedate_to_datetime
+from . import log_util
+
+logger = log_util.get_logger(__name__)
+
+
+class RetryPolicy:
+    """Decides whether and when a failed request to api.elsevier.com is
+        retried: requests that fail with one of the given status codes, or
+        with a connection error or timeout, are retried up to max_retries
+        times with exponential backoff and full jitter. A Retry-After header
+        on the response takes precedence over the computed backoff. Budget,
+        if given, caps the total number of retries the policy allows over
+        its lifetime, so that a failing API does not eat up the quota."""
+
+    def __init__(self, max_retries = 3, backoff_factor = 0.5, max_backoff = 60,
+                 status_codes = (429, 500, 502, 503, 504),
+                 respect_retry_after = True, budget = None):
+        """Initializes a retry policy."""
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.status_codes = frozenset(status_codes)
+        self.respect_retry_after = respect_retry_after
+        self._budget = budget
+        self._lock = threading.Lock()
+
+    @property
+    def budget(self):
+        """Gets the number of retries left in the policy's budget; None if
+            the number of retries is not capped."""
+        return self._budget
+
+    def _retry_after(self, response):
+        """Returns the number of seconds the response's Retry-After header
+            asks to wait, or None if there is no (valid) header."""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def is_retryable(self, response):
+        """Returns True if the response has a status code worth retrying.
+            Responses that report the API key's quota is exceeded are not,
+            as retrying them cannot succeed until the quota is reset."""
+        if response.status_code not in self.status_codes:
+            return False
+        els_status = response.headers.get('X-ELS-Status', '')
+        return not els_status.upper().startswith('QUOTA_EXCEEDED')
+
+    def backoff(self, attempt, response = None):
+        """Returns the number of seconds to wait before the given (zero-based)
+            retry attempt; never more than max_backoff, even if the response
+            asks to wait longer."""
+        if response is not None and self.respect_retry_after:
+            retry_after = self._retry_after(response)
+            if retry_after is not None:
+                if retry_after > self.max_backoff:
+                    logger.warning('Retry-After of %.0f s capped at %.0f s'
+                                   % (retry_after, self.max_backoff))
+                return min(retry_after, self.max_backoff)
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+
+    def retry(self, attempt, response = None):
+        """Given the number of retries made so far for a request and the
+            failed response (None for connection errors and timeouts),
+            returns the number of seconds to wait before retrying, or None
+            if the request should not be retried."""
+        if attempt >= self.max_retries:
+            return None
+        if response is not None and not self.is_retryable(response):
+            return None
+        with self._lock:
+            if self._budget is not None:
+                if self._budget <= 0:
+                    logger.warning('Retry budget exhausted')
+                    return None
+                self._budget -= 1
+        return self.backoff(attempt, response)
@@ -0,0 +1,121 @@
+"""The result sink module of elsapy. Used by elssearch.
+    Additional resources:
+    * https://github.com/ElsevierDev/elsapy
+    * https://dev.elsevier.com
+    * https://api.elsevier.com"""
+
+import json
+from abc import ABCMeta, abstractmethod
+from . import log_util
+from .utils import open_compressed
+
+logger = log_util.get_logger(__name__)
+
+
+class ResultSink(metaclass=ABCMeta):
+    """A destination that search results are written to page by page, as
+        they are retrieved. Sinks are context managers; close them (or leave
+        the with block) once all results have been written."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @abstractmethod
+    def write(self, page):
+        """Writes a page (i.e. a list) of results to the sink."""
+
+    def close(self):
+        """Flushes and closes the sink."""
+        pass
+
+
+class JsonLinesSink(ResultSink):
+    """Writes results to a JSON Lines file, one result per line. The file is
+        gzip-compressed if compress = True or its name ends with .gz."""
+
+    def __init__(self, path, compress = False, append = False):
+        """Initializes a sink that writes to the given path, overwriting the
+            file unless append = True."""
+        self.path = str(path)
+        if compress and not self.path.endswith('.gz'):
+            self.path += '.gz'
+        self._file = open_compressed(self.path, 'at' if append else 'wt')
+
+    def write(self, page):
+        """Writes a page of results to the file."""
+        for result in page:
+            self._file.write(json.dumps(result) + '\n')
+
+    def close(self):
+        """Closes the file."""
+        self._file.close()
+        logger.info('Wrote results to ' + self.path)
+
+
+class ParquetSink(ResultSink):
+    """Writes results to a Parquet file, one row group per page. Requires
+        pyarrow. All columns are stored as strings, with nested values (such
+        as the 'link' field) encoded as JSON. The columns are those given,
+        or else the fields of the first page; other fields are dropped."""
+
+    def __init__(self, path, columns = None):
+        """Initializes a sink that writes to the given path."""
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ImportError('ParquetSink requires pyarrow: pip install pyarrow')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = str(path)
+        self._columns = list(columns) if columns else None
+        self._writer = None
+        self._dropped = set()
+
+    @staticmethod
+    def _to_str(value):
+        """Returns a field value as a string (or None)."""
+        if value is None or isinstance(value, str):
+            return value
+        return json.dumps(value)
+
+    def write(self, page):
+        """Writes a page of results to the file as a row group."""
+        if not page:
+            return
+        if self._columns is None:
+            self._columns = list(dict.fromkeys(k for result in page for k in result))
+        if self._writer is None:
+            schema = self._pa.schema(
+                [(column, self._pa.string()) for column in self._columns])
+            self._writer = self._pq.ParquetWriter(self.path, schema)
+        dropped = set(k for result in page for k in result) - set(self._columns)
+        if dropped - self._dropped:
+            logger.warning('Dropping fields not in Parquet schema: '
+                           + ', '.join(sorted(dropped - self._dropped)))
+            self._dropped |= dropped
+        table = self._pa.table(
+            {column: [self._to_str(result.get(column)) for result in page]
+             for column in self._columns},
+            schema = self._writer.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        """Closes the file."""
+        if self._writer is not None:
+            self._writer.close()
+            logger.info('Wrote results to ' + self.path)
+
+
+class CallbackSink(ResultSink):
+    """Passes each page of results to a callback function."""
+
+    def __init__(self, callback):
+        """Initializes a sink that calls callback(page) for each page."""
+        self._callback = callback
+
+    def write(self, page):
+        """Passes a page of results to the callback."""
+        self._callback(page)
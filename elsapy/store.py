@@ -0,0 +1,302 @@
+"""The entity store module of elsapy. Used by elsentity.
+    Additional resources:
+    * https://github.com/ElsevierDev/elsapy
+    * https://dev.elsevier.com
+    * https://api.elsevier.com"""
+
+import json, sqlite3, threading, time, zlib
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from urllib.parse import quote_plus
+from . import log_util
+try:
+    import pathlib
+except ImportError:
+    import pathlib2 as pathlib
+
+logger = log_util.get_logger(__name__)
+
+
+class EntityStore(metaclass=ABCMeta):
+    """The base class for stores that ElsEntity.write() writes entities to,
+        and that conditional reads check for a local copy. Entities are keyed
+        by their type (the name of their class) and URI, and stored with
+        their data and the validators ('etag', 'last_modified' and the time
+        they were 'fetched') of the response they were read from."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @abstractmethod
+    def put(self, entity_type, uri, data, validators = None):
+        """Stores an entity's data, and its validators if given."""
+
+    def put_many(self, entries):
+        """Stores (entity_type, uri, data, validators) entries in one batch."""
+        for entry in entries:
+            self.put(*entry)
+
+    @abstractmethod
+    def get(self, entity_type, uri):
+        """Returns the stored data and validators of an entity, or None if
+            the entity is not in the store."""
+
+    @abstractmethod
+    def put_validators(self, entity_type, uri, validators):
+        """Updates the validators of a stored entity, e.g. once a
+            conditional request has found that its data is still current."""
+
+    def close(self):
+        """Releases the store's resources."""
+        pass
+
+
+class JsonFileStore(EntityStore):
+    """Stores each entity as a .json file in a directory, with the
+        url-encoded URI as the filename and its validators, if any, next to
+        it in a .meta.json file. The type of an entity is not used. This is
+        the store clients use by default."""
+
+    def __init__(self, path):
+        """Initializes a store in the given directory."""
+        self._path = pathlib.Path(path)
+
+    # properties
+    @property
+    def path(self):
+        """Gets the directory the store is kept in"""
+        return self._path
+
+    def file(self, uri, suffix = '.json'):
+        """Returns the path of the file an entity is stored in."""
+        return self._path / (quote_plus(uri) + suffix)
+
+    def put(self, entity_type, uri, data, validators = None):
+        """Writes an entity's data, and its validators if given."""
+        with self.file(uri).open(mode = 'w') as data_file:
+            json.dump(data, data_file)
+        if validators:
+            self.put_validators(entity_type, uri, validators)
+
+    def get(self, entity_type, uri):
+        """Returns the stored data and validators of an entity, or None if it
+            has not been written (or cannot be read). Without a .meta.json
+            file, the time the entity was fetched is taken to be the time
+            its file was last modified."""
+        data_path = self.file(uri)
+        meta_path = self.file(uri, '.meta.json')
+        try:
+            with data_path.open() as data_file:
+                data = json.load(data_file)
+            if meta_path.exists():
+                with meta_path.open() as meta_file:
+                    validators = json.load(meta_file)
+            else:
+                validators = {'fetched': data_path.stat().st_mtime}
+        except (OSError, ValueError):
+            return None
+        return data, validators
+
+    def put_validators(self, entity_type, uri, validators):
+        """Writes the validators of an entity to its .meta.json file."""
+        with self.file(uri, '.meta.json').open(mode = 'w') as meta_file:
+            json.dump(validators, meta_file)
+
+
+class MemoryStore(EntityStore):
+    """Keeps up to max_entries entities in memory, evicting the least
+        recently used ones, so that reading the same entity again within a
+        process costs nothing. Data is not copied, so entities read from
+        the store share it. Safe to share between threads."""
+
+    def __init__(self, max_entries = 1024):
+        """Initializes an empty store."""
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def put(self, entity_type, uri, data, validators = None):
+        """Keeps an entity's data, and its validators if given; the time it
+            was fetched defaults to now."""
+        validators = dict(validators or {})
+        validators.setdefault('fetched', time.time())
+        with self._lock:
+            self._entries[(entity_type, uri)] = (data, validators)
+            self._entries.move_to_end((entity_type, uri))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def get(self, entity_type, uri):
+        """Returns the data and validators of an entity, or None if it is not
+            in the store."""
+        with self._lock:
+            entry = self._entries.get((entity_type, uri))
+            if entry is not None:
+                self._entries.move_to_end((entity_type, uri))
+        return entry
+
+    def put_validators(self, entity_type, uri, validators):
+        """Updates the validators of an entity in the store."""
+        with self._lock:
+            entry = self._entries.get((entity_type, uri))
+            if entry is not None:
+                self._entries[(entity_type, uri)] = (entry[0], dict(validators))
+
+    def clear(self):
+        """Removes all entities from the store."""
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteStore(EntityStore):
+    """Stores entities in a single SQLite database file, keyed by type and
+        URI, with their data as zlib-compressed JSON and an index on the
+        time they were fetched. Safe to share between threads."""
+
+    # class variables
+    _schema = [
+        """CREATE TABLE IF NOT EXISTS entities (
+            type            TEXT NOT NULL,
+            uri             TEXT NOT NULL,
+            fetched         REAL NOT NULL,
+            etag            TEXT,
+            last_modified   TEXT,
+            data            BLOB NOT NULL,
+            PRIMARY KEY (type, uri))""",
+        """CREATE INDEX IF NOT EXISTS entities_fetched ON entities (fetched)""",
+        ]
+    _export_batch_size = 10000              ## Rows per Parquet row group
+
+    def __init__(self, path, compress_level = 6):
+        """Initializes a store in the given database file, creating it if
+            need be. Compress_level is the zlib level data is compressed
+            with."""
+        self._path = pathlib.Path(path)
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self._path), check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode = WAL')
+            for statement in self._schema:
+                self._db.execute(statement)
+
+    # properties
+    @property
+    def path(self):
+        """Gets the database file the store is kept in"""
+        return self._path
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+
+    def _row(self, entity_type, uri, data, validators):
+        """Returns the table row for an entity."""
+        validators = validators or {}
+        return (entity_type, uri, validators.get('fetched') or time.time(),
+                validators.get('etag'), validators.get('last_modified'),
+                zlib.compress(json.dumps(data).encode('utf-8'), self.compress_level))
+
+    def put(self, entity_type, uri, data, validators = None):
+        """Stores an entity's data, and its validators if given; the time it
+            was fetched defaults to now."""
+        self.put_many([(entity_type, uri, data, validators)])
+
+    def put_many(self, entries):
+        """Stores (entity_type, uri, data, validators) entries in one transaction."""
+        rows = [self._row(*entry) for entry in entries]
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)', rows)
+        logger.info('Stored ' + str(len(rows)) + ' entities in ' + str(self._path))
+
+    def get(self, entity_type, uri):
+        """Returns the stored data and validators of an entity, or None if it
+            is not in the store."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT fetched, etag, last_modified, data FROM entities'
+                ' WHERE type = ? AND uri = ?', (entity_type, uri)).fetchone()
+        if row is None:
+            return None
+        fetched, etag, last_modified, data = row
+        validators = {'etag': etag, 'last_modified': last_modified, 'fetched': fetched}
+        return json.loads(zlib.decompress(data).decode('utf-8')), validators
+
+    def put_validators(self, entity_type, uri, validators):
+        """Updates the validators of a stored entity."""
+        with self._lock, self._db:
+            self._db.execute(
+                'UPDATE entities SET fetched = ?, etag = ?, last_modified = ?'
+                ' WHERE type = ? AND uri = ?',
+                (validators.get('fetched') or time.time(), validators.get('etag'),
+                 validators.get('last_modified'), entity_type, uri))
+
+    def _select(self, entity_type = None, since = None):
+        """Returns the query and parameters that select the entities of a
+            type (all types if None) fetched since a Unix timestamp (at any
+            time if None), in order of fetch time."""
+        clauses, params = [], []
+        if entity_type:
+            clauses.append('type = ?')
+            params.append(entity_type)
+        if since:
+            clauses.append('fetched >= ?')
+            params.append(since)
+        query = 'SELECT type, uri, fetched, etag, last_modified, data FROM entities'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        return query + ' ORDER BY fetched', params
+
+    def export_parquet(self, path, entity_type = None, since = None):
+        """Exports the entities of a type (all types if None) fetched since a
+            Unix timestamp (at any time if None) to a Parquet file, with the
+            data as JSON strings. Requires pyarrow. Returns the number of
+            entities exported."""
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ImportError('export_parquet requires pyarrow: pip install pyarrow')
+        schema = pyarrow.schema([
+            ('type', pyarrow.string()),
+            ('uri', pyarrow.string()),
+            ('fetched', pyarrow.float64()),
+            ('etag', pyarrow.string()),
+            ('last_modified', pyarrow.string()),
+            ('data', pyarrow.string()),
+            ])
+        query, params = self._select(entity_type, since)
+        exported = 0
+        ## A separate connection, so that other threads can use the store
+        ##  while the export runs.
+        db = sqlite3.connect(str(self._path))
+        try:
+            with pyarrow.parquet.ParquetWriter(str(path), schema) as writer:
+                cursor = db.execute(query, params)
+                rows = cursor.fetchmany(self._export_batch_size)
+                while rows:
+                    columns = [list(column) for column in zip(*rows)]
+                    columns[5] = [zlib.decompress(data).decode('utf-8')
+                                  for data in columns[5]]
+                    writer.write_table(pyarrow.Table.from_arrays(
+                        [pyarrow.array(column, type = field.type)
+                         for column, field in zip(columns, schema)],
+                        schema = schema))
+                    exported += len(rows)
+                    rows = cursor.fetchmany(self._export_batch_size)
+        finally:
+            db.close()
+        logger.info('Exported ' + str(exported) + ' entities to ' + str(path))
+        return exported
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._db.close()
@@ -3,15 +3,54 @@
 project more maintainable.
 """
 
-import pandas as pd
+import pandas as pd, itertools, gzip, operator
 from . import log_util
 
 logger = log_util.get_logger(__name__)
 
 
+def open_compressed(path, mode = 'rt'):
+    '''Opens a (text) file, compressed with gzip if its name ends with .gz,
+    or with Zstandard if it ends with .zst (which requires zstandard)'''
+    if str(path).endswith('.gz'):
+        return gzip.open(str(path), mode, encoding = 'utf-8')
+    elif str(path).endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('.zst files require zstandard: pip install zstandard')
+        return zstandard.open(str(path), mode, encoding = 'utf-8')
+    else:
+        return open(str(path), mode.replace('t', ''), encoding = 'utf-8')
+
+
+def chunked(iterable, size):
+    '''Splits an iterable into lists of (at most) size elements'''
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+_rel_link = operator.itemgetter('@rel', '@href')
+_ref_link = operator.itemgetter('@ref', '@href')
+
+def _link_dict(links):
+    '''Turns a list of link objects from an API response into a dict of URLs
+    by link type; returns None for missing links'''
+    if not isinstance(links, list) or not links:
+        return None
+    # To deal with inconsistency. In some API responses, the link type 
+    #   field uses '@rel' as key; in others, it uses '@ref'.
+    return dict(map(_rel_link if '@rel' in links[0] else _ref_link, links))
+
+
 def recast_df(df):
     '''Recasts a data frame so that it has proper date fields and a more 
-    useful data structure for URLs'''
+    useful data structure for URLs. Conversions are done column-wise; 
+    missing or malformed values become nulls (integer fields become the 
+    nullable Int64 type if they have any).'''
     int_resp_fields = [
             'document-count',
             'citedby-count',
@@ -22,23 +61,59 @@ def recast_df(df):
     
     # Modify data structure for storing links/URLs in a DF
     if 'link' in df.columns:
-        if '@rel' in df.link[0][0].keys():
-            # To deal with inconsistency. In some API responses, the link type 
-            #   field uses '@rel' as key; in others, it uses '@ref'.
-            link_type_key ='@rel'
-        else:
-            link_type_key = '@ref'
-        df['link'] = df.link.apply(
-            lambda x: dict([(e[link_type_key], e['@href']) for e in x]))
+        df['link'] = [_link_dict(x) for x in df['link'].tolist()]
     # Recast fields that contain integers from strings to the integer type
     for int_field in int_resp_fields:
         if int_field in df.columns:
-            df[int_field] = df[int_field].apply(
-                    int)
+            try:
+                df[int_field] = df[int_field].astype('int64')
+            except (TypeError, ValueError):
+                # Missing or malformed values
+                df[int_field] = pd.to_numeric(
+                    df[int_field], errors = 'coerce').astype('Int64')
     # Recast fields that contain datetime from strings to a datetime type
     for date_field in date_resp_fields:
         if date_field in df.columns:
             logger.info("Converting {}".format(date_field))
-            df[date_field] = df[date_field].apply(
-                    pd.Timestamp)
-    return df
\ No newline at end of file
+            df[date_field] = pd.to_datetime(df[date_field], errors = 'coerce')
+    return df
+
+
+def _string_dtype():
+    '''Returns the most compact string dtype available: Arrow-backed if
+    pyarrow is installed'''
+    try:
+        import pyarrow
+        return pd.StringDtype('pyarrow')
+    except ImportError:
+        return pd.StringDtype()
+
+
+def compact_df(df, max_category_ratio = 0.5):
+    '''Converts a (recast) data frame to use less memory: the 'link' column
+    of dicts is split into one 'link_<type>' column per link type, string
+    columns with few distinct values (at most max_category_ratio of the
+    number of rows) become categoricals, other string columns become
+    (Arrow-backed, if pyarrow is installed) string columns, and integer
+    columns are downcast to the smallest type that holds their values.
+    Columns holding lists or dicts are left as they are.'''
+    if 'link' in df.columns:
+        links = pd.DataFrame(
+            [x if isinstance(x, dict) else {} for x in df['link'].tolist()],
+            index = df.index)
+        links.columns = ['link_' + str(c) for c in links.columns]
+        df = pd.concat([df.drop(columns = 'link'), links], axis = 1)
+    string_dtype = _string_dtype()
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_integer_dtype(values.dtype):
+            df[col] = pd.to_numeric(values, downcast = 'integer')
+        elif (pd.api.types.is_object_dtype(values.dtype)
+              or pd.api.types.is_string_dtype(values.dtype)):
+            if pd.api.types.infer_dtype(values, skipna = True) != 'string':
+                continue
+            if values.nunique() <= max_category_ratio * len(values):
+                df[col] = values.astype('category')
+            else:
+                df[col] = values.astype(string_dtype)
+    return df
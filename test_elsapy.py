@@ -5,12 +5,19 @@
 ## - this will require a shared 'utility class'
 ## - add a module that integrates all
 
-from elsapy.elsclient import ElsClient
+from elsapy.elsclient import ElsClient, AsyncElsClient
 from elsapy.elsprofile import ElsAuthor, ElsAffil
 from elsapy.elsdoc import FullDoc, AbsDoc
-from elsapy.elssearch import ElsSearch
+from elsapy.elssearch import ElsSearch, SearchBatch
+from elsapy.ratelimit import RateLimiter, endpoint_family
+from elsapy.retry import RetryPolicy
+from elsapy.cache import ResponseCache
+from elsapy.store import SqliteStore
+from elsapy.sinks import JsonLinesSink
+from elsapy.utils import recast_df, compact_df
 from urllib.parse import quote_plus as url_encode
-import json, pathlib
+import pandas as pd
+import asyncio, gzip, json, pathlib, requests
 
 ## Load good client configuration
 conFile = open("config.json")
@@ -68,6 +75,189 @@ class TestElsClient:
         assert my_client.api_key == config['apikey']
         assert my_client.inst_token == config['insttoken']
 
+    def test_page_size(self):
+        """Test case: the page size defaults to the max. for the index and
+            view, and is capped at that max."""
+        my_client = ElsClient(config['apikey'])
+        assert my_client.page_size('scopus') == 200
+        assert my_client.page_size('scopus', 'COMPLETE') == 25
+        my_client.num_res = 100
+        assert my_client.page_size('scopus') == 100
+        assert my_client.page_size('scopus', 'COMPLETE') == 25
+        assert my_client.page_size('scopus', count = 500) == 200
+
+    def test_context_manager(self):
+        """Test case: a client used as a context manager reuses its connection
+            pool for all requests and can still be used after it is closed"""
+        with ElsClient(config['apikey'], inst_token = config['insttoken'],
+                       pool_maxsize = 2) as my_client:
+            assert AbsDoc(scp_id = 84872135457).read(my_client) == True
+            assert AbsDoc(scp_id = 84872135457).read(my_client) == True
+        assert AbsDoc(scp_id = 84872135457).read(my_client) == True
+
+class TestAsyncElsClient:
+    """Test asyncio client functionality"""
+
+    def test_gather_reads(self):
+        """Test case: entity reads and searches can be awaited concurrently"""
+        async def read_all():
+            async with AsyncElsClient(config['apikey'], inst_token = config['insttoken'],
+                                      max_concurrency = 4) as my_client:
+                docs = [AbsDoc(scp_id = 84872135457), ElsAuthor(author_id = 55070335500),
+                        ElsAffil(affil_id = 60101411), FullDoc(sd_pii = 'S1674927814000082')]
+                search = ElsSearch("affil(amsterdam)", "affiliation")
+                results = await asyncio.gather(
+                    *[doc.read_async(my_client) for doc in docs],
+                    search.execute_async(my_client))
+                return docs, search, results
+        docs, search, results = asyncio.run(read_all())
+        assert results[:4] == [True, True, True, True]
+        assert len(search.results) > 0
+
+    def test_reuse_after_close(self):
+        """Test case: a client can still run work after it has been closed"""
+        async def run_twice(my_client):
+            async with my_client:
+                first = await my_client.run_async(sum, [1, 2])
+            return first, await my_client.run_async(sum, [3, 4])
+        my_client = AsyncElsClient(config['apikey'], inst_token = config['insttoken'])
+        assert asyncio.run(run_twice(my_client)) == (3, 7)
+
+
+class TestRateLimiter:
+    """Test request throttling functionality"""
+
+    def test_endpoint_family(self):
+        """Test case: URLs are mapped to the right endpoint family"""
+        assert endpoint_family(ElsSearch("affil(amsterdam)", "affiliation").uri) == 'search'
+        assert endpoint_family(AbsDoc(scp_id = 84872135457).uri) == 'abstract'
+        assert endpoint_family(ElsAuthor(author_id = 55070335500).uri) == 'author'
+        assert endpoint_family(FullDoc(sd_pii = 'S1674927814000082').uri) == 'article'
+
+    def test_quota(self):
+        """Test case: after a request, the client reports the quota left for
+            that endpoint family"""
+        my_client = ElsClient(config['apikey'], inst_token = config['insttoken'],
+                              rate_limiter = RateLimiter({'abstract': 2}))
+        AbsDoc(scp_id = 84872135457).read(my_client)
+        assert my_client.quota['abstract']['remaining'] >= 0
+
+    def test_shared_per_key(self):
+        """Test case: clients with the same API key share one rate limiter,
+            unless one is set explicitly"""
+        client_1 = ElsClient(config['apikey'])
+        client_2 = ElsClient(config['apikey'])
+        client_3 = ElsClient(config['apikey'], rate_limiter = RateLimiter())
+        assert client_1.rate_limiter is client_2.rate_limiter
+        assert client_1.rate_limiter is not client_3.rate_limiter
+
+
+class TestRetryPolicy:
+    """Test retry functionality"""
+
+    def response(status_code, headers = {}):
+        """Returns a response object with the given status and headers"""
+        r = requests.Response()
+        r.status_code = status_code
+        r.headers.update(headers)
+        return r
+
+    def test_retry_status(self):
+        """Test case: only transient errors are retried, up to max_retries"""
+        policy = RetryPolicy(max_retries = 2)
+        assert policy.retry(0, TestRetryPolicy.response(503)) is not None
+        assert policy.retry(0, TestRetryPolicy.response(404)) is None
+        assert policy.retry(2, TestRetryPolicy.response(503)) is None
+        assert policy.retry(0, TestRetryPolicy.response(429,
+            {'X-ELS-Status': 'QUOTA_EXCEEDED - Quota Exceeded'})) is None
+
+    def test_retry_after_and_budget(self):
+        """Test case: Retry-After is honored and the budget caps retries"""
+        policy = RetryPolicy(budget = 1)
+        assert policy.retry(0, TestRetryPolicy.response(429, {'Retry-After': '7'})) == 7
+        assert policy.retry(0, TestRetryPolicy.response(429)) is None
+
+    def test_retry_after_capped(self):
+        """Test case: a Retry-After beyond max_backoff is capped at it"""
+        policy = RetryPolicy(max_backoff = 60)
+        assert policy.retry(0, TestRetryPolicy.response(503, {'Retry-After': '86400'})) == 60
+
+
+class TestResponseCache:
+    """Test response cache functionality"""
+
+    def test_put_get(self):
+        """Test case: cached responses are found by normalized URL and the
+            least recently used ones are evicted beyond the max. size"""
+        cache = ResponseCache(test_path / 'cache', max_size = 300)
+        cache.clear()
+        cache.put(ElsSearch("a", "scopus").uri + "&field=eid,dc:title", {'a': 1})
+        cache.put(ElsSearch("b", "scopus").uri, {'b': 2})
+        assert cache.get(ElsSearch("a", "scopus").uri + "&field=dc:title,eid") == {'a': 1}
+        cache.put(ElsSearch("c", "scopus").uri, {'c': 3})
+        assert cache.get(ElsSearch("b", "scopus").uri) is None
+        assert cache.get(ElsSearch("c", "scopus").uri) == {'c': 3}
+        assert cache.stats['hits'] == 2
+
+    def test_client_cache(self):
+        """Test case: a second read of the same entity is served from the cache"""
+        my_client = ElsClient(config['apikey'], inst_token = config['insttoken'],
+                              local_dir = test_path, cache = True)
+        AbsDoc(scp_id = 84872135457).read(my_client)
+        AbsDoc(scp_id = 84872135457).read(my_client)
+        assert my_client.cache.stats['hits'] >= 1
+
+
+class TestSqliteStore:
+    """Test SQLite entity store functionality"""
+
+    def test_put_get(self):
+        """Test case: entities written in a batch are read back with their
+            validators, and entities of another type are not"""
+        with SqliteStore(test_path / 'store.db') as store:
+            store.put_many([
+                ('ElsAuthor', 'https://api.elsevier.com/a/1', {'a': 1}, {'etag': 'x'}),
+                ('ElsAuthor', 'https://api.elsevier.com/a/2', {'a': 2}, None),
+                ])
+            data, validators = store.get('ElsAuthor', 'https://api.elsevier.com/a/1')
+            assert data == {'a': 1}
+            assert validators['etag'] == 'x'
+            assert store.get('ElsAffil', 'https://api.elsevier.com/a/1') is None
+            assert len(store) == 2
+
+
+class TestRecastDf:
+    """Test data frame conversion functionality"""
+
+    def test_recast_missing_values(self):
+        """Test case: missing and malformed values become nulls, and links
+            become dicts by link type"""
+        df = recast_df(pd.DataFrame([
+            {'citedby-count': '3', 'prism:coverDate': '2012-01-31',
+             'link': [{'@ref': 'self', '@href': 'https://api.elsevier.com'}]},
+            {'citedby-count': None, 'prism:coverDate': 'n/a'},
+            ]))
+        assert df['citedby-count'][0] == 3
+        assert pd.isna(df['citedby-count'][1])
+        assert df['prism:coverDate'][0] == pd.Timestamp('2012-01-31')
+        assert pd.isna(df['prism:coverDate'][1])
+        assert df['link'][0] == {'self': 'https://api.elsevier.com'}
+        assert df['link'][1] is None
+
+    def test_compact(self):
+        """Test case: compact frames have categoricals, downcast integers
+            and a column per link type"""
+        df = compact_df(recast_df(pd.DataFrame([
+            {'eid': str(i), 'citedby-count': str(i), 'subtype': 'ar',
+             'link': [{'@ref': 'self', '@href': 'https://api.elsevier.com'}]}
+            for i in range(10)])))
+        assert 'link' not in df.columns
+        assert df['link_self'][0] == 'https://api.elsevier.com'
+        assert df['subtype'].dtype == 'category'
+        assert df['eid'].dtype != 'category'
+        assert df['citedby-count'].dtype == 'int8'
+
+
 class TestElsAuthor:
     """Test author object functionality"""
     
@@ -142,8 +332,44 @@ class TestElsAuthor:
             self.myAuth.data['coredata']['cited-by-count'] and 
             self.myAuth.data['coredata']['document-count'] and 
             self.myAuth.data['h-index'])
+
+    def test_read_metrics_batch(self):
+        """Test case: metrics read in a batch match those read one by one"""
+        authors = ElsAuthor.read_metrics_batch(
+            [self.auth_id_int, 7004367821], self.good_client)
+        assert len(authors) == 2
+        assert authors[0].uri == self.auth_uri
+        assert (authors[0].data['coredata']['document-count'] ==
+                self.myAuth.data['coredata']['document-count'])
         
             
+    def test_conditional_read(self):
+        """Test case: with conditional requests, an author that was written
+            before is read from its local copy while it is still current"""
+        cond_path = test_path / 'conditional'
+        if not cond_path.exists():
+            cond_path.mkdir()
+        my_client = ElsClient(config['apikey'], inst_token = config['insttoken'],
+                              local_dir = cond_path, conditional_requests = True,
+                              max_age = 3600)
+        first_auth = ElsAuthor(uri = self.auth_uri)
+        assert first_auth.read(my_client) == True
+        first_auth.write()
+        second_auth = ElsAuthor(uri = self.auth_uri)
+        assert second_auth.read(my_client) == True
+        assert second_auth.data == first_auth.data
+
+    def test_read_local(self):
+        """Test case: with a local cache policy, an author that was written
+            before is read from the local store"""
+        self.myAuth.write()
+        local_auth = ElsAuthor(uri = self.auth_uri)
+        assert local_auth.read(self.good_client, cache_policy = 'local-only') == True
+        assert local_auth.data == self.myAuth.data
+        assert ElsAuthor(author_id = 1).read(
+            self.good_client, cache_policy = 'local-only') == False
+
+
 class TestElsAffil:
     """Test affiliation functionality"""
     
@@ -199,6 +425,18 @@ class TestElsAffil:
     def test_read_docs(self):
         self.myAff.read_docs()
         assert len(self.myAff.doc_list) == int(self.myAff.data['coredata']['document-count'])
+
+    def test_iter_docs(self):
+        """Test case: iterating over the documents gives the same documents,
+            in the same order, as reading them into a list"""
+        docs = list(self.myAff.iter_docs())
+        assert [doc['eid'] for doc in docs] == [doc['eid'] for doc in self.myAff.doc_list]
+
+    def test_write_docs(self):
+        """Test case: the doclist written to a compressed file is read back
+            the same"""
+        assert self.myAff.write_docs(compress = 'gzip') == True
+        assert list(self.myAff.iter_written_docs()) == self.myAff.doc_list
             
  
 class TestAbsDoc:
@@ -253,6 +491,30 @@ class TestAbsDoc:
         self.myAbsDoc.write()
         assert util.file_exist_with_id(self.myAbsDoc.data['coredata']['dc:identifier'].split(':')[1])
 
+    def test_read_batch(self):
+        """Test case: documents read in a batch have their search record as data"""
+        docs = AbsDoc.read_batch([self.scp_id_int, '2-s2.0-84872135457'], self.good_client)
+        assert len(docs) == 2
+        assert docs[0].uri == self.abs_uri
+        assert docs[0].title == self.myAbsDoc.title
+
+    def test_read_many(self):
+        """Test case: bulk reads yield one result per ID, and a bad ID does
+            not stop the batch"""
+        results = list(AbsDoc.read_many(
+            [self.scp_id_int, self.abs_uri, 1], self.good_client, workers = 2))
+        assert len(results) == 3
+        assert sorted(r.error is None for r in results) == [False, True, True]
+
+    def test_read_many_invalid_ids(self):
+        """Test case: invalid IDs in the middle of the input are reported
+            without dropping the IDs after them"""
+        results = list(AbsDoc.read_many(
+            [self.scp_id_int, '', '', self.abs_uri], self.good_client, workers = 1))
+        assert sorted(str(r.id) for r in results) == sorted(
+            ['', '', str(self.scp_id_int), self.abs_uri])
+        assert [r.entity for r in results if r.id == ''] == [None, None]
+
 class TestFullDoc:
     """Test ScienceDirect article functionality"""
     
@@ -306,6 +568,24 @@ class TestFullDoc:
         ## TODO: replace following (strung-together replace) with regex
         assert util.file_exist_with_id(
                 self.myFullDoc.data['coredata']['pii'].replace('-','').replace('(','').replace(')',''))
+
+    def test_download(self):
+        """Test case: the full text is downloaded to a file as XML, JSON
+            read lazily is parsed on first access, and lazy reads refuse a
+            local cache policy"""
+        my_client = ElsClient(config['apikey'], inst_token = config['insttoken'],
+                              local_dir = test_path / 'downloads')
+        xml_doc = FullDoc(uri = self.full_pii_uri)
+        assert xml_doc.download(accept = 'xml', els_client = my_client) == True
+        assert xml_doc.download_path.stat().st_size > 0
+        lazy_doc = FullDoc(uri = self.full_pii_uri)
+        assert lazy_doc.read(my_client, lazy = True) == True
+        assert lazy_doc.title == self.myFullDoc.title
+        try:
+            FullDoc(uri = self.full_pii_uri).read(my_client, 'local-first', lazy = True)
+            assert False
+        except ValueError:
+            pass
  
 
  
@@ -348,3 +628,119 @@ class TestSearch:
         for search in self.searches:
             search.execute(self.good_client)
         assert True
+
+    def test_iter_results(self):
+        '''Test case: results are streamed lazily and iteration can stop early.'''
+        search = ElsSearch("AFFIL(dartmouth) AND AUTHOR-NAME(lewis) AND PUBYEAR > 2011", "scopus")
+        results = search.iter_results(self.good_client)
+        first_results = [next(results) for i in range(30)]
+        results.close()
+        assert len(first_results) == 30
+        assert len(set(r['eid'] for r in first_results)) == 30
+
+    def test_execution_sink(self):
+        '''Test case: results are written to a sink page by page, and no
+            dump file is written without one.'''
+        search = ElsSearch("affil(amsterdam)", "affiliation")
+        sink_path = test_path / 'affil_results.jsonl.gz'
+        with JsonLinesSink(sink_path) as sink:
+            search.execute(self.good_client, sink = sink)
+        with gzip.open(str(sink_path), 'rt') as f:
+            assert [json.loads(line) for line in f] == search.results
+
+    def test_execution_workers(self):
+        '''Test case: fetching pages concurrently gives the same results, in
+            the same order, as fetching them one by one.'''
+        search = ElsSearch("star trek vs star wars", "sciencedirect")
+        search.execute(self.good_client, get_all = True)
+        parallel_search = ElsSearch("star trek vs star wars", "sciencedirect")
+        parallel_search.execute(self.good_client, get_all = True, workers = 4)
+        assert parallel_search.results == search.results
+
+    def test_iter_partitioned(self):
+        '''Test case: a partitioned search yields every result exactly once;
+            a search small enough to retrieve at once is not split.'''
+        search = ElsSearch("AFFIL(dartmouth) AND AUTHOR-NAME(lewis)", "scopus")
+        results = list(search.iter_partitioned(self.good_client, first_year = 2010,
+                                               last_year = 2020, workers = 2))
+        eids = [r['eid'] for r in results]
+        assert len(eids) == len(set(eids))
+        full_search = ElsSearch("AFFIL(dartmouth) AND AUTHOR-NAME(lewis)", "scopus")
+        full_search.execute(self.good_client, get_all = True, use_cursor = True)
+        assert sorted(eids) == sorted(r['eid'] for r in full_search.results)
+
+    def test_execution_resume(self):
+        '''Test case: resuming a finished, checkpointed search restores its
+            results without fetching them again.'''
+        checkpoint = test_path / 'scopus_search.checkpoint'
+        search = ElsSearch("AFFIL(dartmouth) AND AUTHOR-NAME(lewis) AND PUBYEAR > 2011", "scopus")
+        search.execute(self.good_client, get_all = True, use_cursor = True,
+                       checkpoint = checkpoint)
+        resumed_search = ElsSearch(search.query, search.index)
+        resumed_search.execute(ElsClient("dummy"), get_all = True, use_cursor = True,
+                               resume = checkpoint)
+        assert resumed_search.results == search.results
+
+    def test_execution_resume_after_failure(self):
+        """Test case: a checkpointed search that fails part-way resumes with
+            the options it was started with, and ends up with every result."""
+        checkpoint = test_path / 'scopus_search_failed.checkpoint'
+        query = "AFFIL(dartmouth) AND AUTHOR-NAME(lewis) AND PUBYEAR > 2011"
+        failing_client = ElsClient(config['apikey'], inst_token = config['insttoken'])
+        exec_request = failing_client.exec_request
+        calls = []
+        def fail_on_third_page(URL):
+            calls.append(URL)
+            if len(calls) > 2:
+                raise requests.HTTPError('simulated failure')
+            return exec_request(URL)
+        failing_client.exec_request = fail_on_third_page
+        search = ElsSearch(query, "scopus")
+        try:
+            search.execute(failing_client, get_all = True, use_cursor = True,
+                           count = 25, checkpoint = checkpoint)
+        except requests.HTTPError:
+            pass
+        assert len(search.results) == 50
+        resumed_search = ElsSearch(query, "scopus")
+        resumed_search.execute(self.good_client, resume = checkpoint)
+        full_search = ElsSearch(query, "scopus")
+        full_search.execute(self.good_client, get_all = True, use_cursor = True)
+        assert len(resumed_search.results) > 50
+        assert ([r['eid'] for r in resumed_search.results]
+                == [r['eid'] for r in full_search.results])
+
+    def test_execution_count_fields(self):
+        '''Test case: count sets the page size and fields restricts the
+            fields returned.'''
+        search = ElsSearch("affil(amsterdam)", "affiliation")
+        search.execute(self.good_client, count = 100, fields = ['dc:identifier'])
+        assert len(search.results) == min(100, search.tot_num_res)
+        assert 'affiliation-name' not in search.results[0]
+
+    def test_count(self):
+        '''Test case: counting a query gives the same total as executing it,
+            and counts for many queries can be had at once.'''
+        search = ElsSearch("affil(amsterdam)", "affiliation")
+        search.execute(self.good_client)
+        assert ElsSearch("affil(amsterdam)", "affiliation").count(self.good_client) == search.tot_num_res
+        counts = ElsSearch.count_many(["affil(amsterdam)", "affil(utrecht)"],
+                                      "affiliation", self.good_client)
+        assert counts["affil(amsterdam)"] == search.tot_num_res
+        assert counts["affil(utrecht)"] > 0
+        counts = ElsSearch.count_many((q for q in ["affil(amsterdam)"]),
+                                      "affiliation", self.good_client)
+        assert counts == {"affil(amsterdam)": search.tot_num_res}
+
+    def test_search_batch(self):
+        '''Test case: a batch of searches merges results by EID and records
+            the queries matching each one.'''
+        queries = ["AFFIL(dartmouth) AND AUTHOR-NAME(lewis) AND PUBYEAR > 2011",
+                   "AFFIL(dartmouth) AND AUTHOR-NAME(lewis) AND PUBYEAR > 2015"]
+        batch = SearchBatch([ElsSearch(query, "scopus") for query in queries])
+        assert batch.execute(self.good_client, get_all = True, workers = 2) == True
+        progress = batch.progress
+        assert len(batch.records) == progress[("scopus", queries[0])]['num_res']
+        assert all(queries[0] in batch.matches[eid] for eid in batch.records)
+        assert (sum(queries[1] in m for m in batch.matches.values()) ==
+                progress[("scopus", queries[1])]['num_res'])